@@ -0,0 +1,251 @@
+from retrieval.revisionstore import revision_key
+from retrieval.wikipedia import load_wikipedia_revisions
+import datetime
+import features
+import joblib
+import numpy as np
+import os
+import os.path
+import pandas as pd
+import platform
+import retrieval
+import scipy
+import simplejson as json
+import sys
+import time
+
+# Timing comparisons for the feature and similarity code paths. Not part of
+# the model fit itself.
+
+def approximate_subsequence_benchmark(films, metric, max_days_apart=1825,
+                                      settings=((128, 64), (128, 32), (64, 32)),
+                                      verbose=False):
+
+    '''
+    Compares approximate (MinHash/LSH) subsequence scores against the exact
+    ones for the same films, for each (num_perm, bands) pair in settings.
+    Returns a dataframe with running times, the fraction of nonzero exact
+    scores recovered (recall), the fraction of total score mass recovered, and
+    the largest absolute score difference.
+    '''
+
+    start = time.time()
+    exact = features.subsequence_scores(films, metric, max_days_apart=max_days_apart).values
+    exact_time = time.time() - start
+    exact_nonzero = exact > 0
+
+    results = [{ 'method': 'exact', 'num_perm': None, 'bands': None,
+                 'seconds': exact_time, 'recall': 1.0, 'mass_recall': 1.0,
+                 'max_abs_error': 0.0 }]
+    for (num_perm, bands) in settings:
+        if verbose:
+            print('Approximate: %d permutations, %d bands' % (num_perm, bands))
+        start = time.time()
+        approximate = features.subsequence_scores(films, metric,
+                                                  max_days_apart=max_days_apart,
+                                                  approximate=True,
+                                                  num_perm=num_perm, bands=bands).toarray()
+        approximate_time = time.time() - start
+        found = np.logical_and(exact_nonzero, approximate > 0)
+        results.append({ 'method': 'approximate', 'num_perm': num_perm, 'bands': bands,
+                         'seconds': approximate_time,
+                         'recall': found.sum() / float(max(exact_nonzero.sum(), 1)),
+                         'mass_recall': exact[found].sum() / float(max(exact.sum(), 1e-12)),
+                         'max_abs_error': np.abs(exact - approximate).max() })
+
+    return pd.DataFrame(results, columns=['method', 'num_perm', 'bands', 'seconds',
+                                          'recall', 'mass_recall', 'max_abs_error'])
+
+### Synthetic data - made-up films and revisions with the same columns and
+### fields as the scraped ones, so the hot paths can be timed at any scale
+
+synthetic_genres = ['Action & Adventure', 'Animation', 'Art House & International', 
+                    'Classics', 'Comedy', 'Documentary', 'Drama', 'Horror', 
+                    'Kids & Family', 'Musical & Performing Arts', 'Mystery & Suspense',
+                    'Romance', 'Science Fiction & Fantasy', 'Special Interest']
+
+synthetic_words = ['the', 'film', 'was', 'released', 'in', 'imax', 'theaters', 'box', 
+                   'office', 'cast', 'plot', 'director', 'sequel', '[[file:poster.jpg]]',
+                   '\n== reception ==\n', '\n']
+
+def synthetic_films(n, cast_size=(2, 8), films_per_person=4, years=(2000, 2012), seed=0):
+    
+    '''
+    Returns a films dataframe of n made-up films, with every column that 
+    features.py reads. Each film has between cast_size[0] and cast_size[1] 
+    actors, drawn from a pool sized so that each person is in about 
+    films_per_person films; opening dates are spread evenly over years. 
+    '''
+    
+    rng = np.random.RandomState(seed)
+    people = max(1, int(n * (cast_size[0] + cast_size[1]) / 2.0 / films_per_person))
+    first_day = datetime.date(years[0], 1, 1).toordinal()
+    last_day = datetime.date(years[1], 12, 31).toordinal()
+    opening_dates = [datetime.date.fromordinal(x) 
+                     for x in rng.randint(first_day, last_day + 1, size=n)]
+    actors = []
+    genres = []
+    for i in range(n):
+        cast = np.unique(rng.randint(0, people, size=rng.randint(cast_size[0], cast_size[1] + 1)))
+        actors.append(','.join('Actor %d' % x for x in cast) if len(cast) > 0 else np.nan)
+        picked = rng.choice(len(synthetic_genres), size=rng.randint(1, 4), replace=False)
+        genres.append(','.join(synthetic_genres[x] for x in picked))
+    return pd.DataFrame({ 'title': ['Film %d' % i for i in range(n)],
+                          'year': [x.year for x in opening_dates],
+                          'opening_date': opening_dates,
+                          'directors': ['Director %d' % x for x in rng.randint(0, max(1, n // 3), size=n)],
+                          'actors': actors,
+                          'genres': genres,
+                          'mpaa_rating': rng.choice(['G', 'PG', 'PG-13', 'R'], size=n),
+                          'runtime': np.where(rng.rand(n) < 0.05, np.nan, rng.randint(80, 180, size=n)),
+                          'opening_gross': rng.randint(10**4, 10**8, size=n).astype(float),
+                          'opening_theaters': rng.randint(1, 4000, size=n),
+                          'wiki_title': [u'Film %d (%d film)' % (i, x.year) for (i, x) in enumerate(opening_dates)] })
+
+def synthetic_revisions(film, n_revisions=20, article_words=300, horizon_end=28, seed=0):
+    
+    '''
+    Returns n_revisions made-up revisions of film's article, newest first in
+    the format of wikipedia.film_revisions(), spread over the horizon_end 
+    days before its opening date. The article starts at article_words words
+    and each revision changes a few of them. 
+    '''
+    
+    rng = np.random.RandomState(seed)
+    words = list(rng.choice(synthetic_words, size=article_words))
+    opening = datetime.datetime.combine(film['opening_date'], datetime.time())
+    seconds = np.sort(rng.randint(1, horizon_end * 86400, size=n_revisions))
+    revisions = []
+    for k in range(n_revisions):
+        position = rng.randint(0, len(words) + 1)
+        words[position:position + rng.randint(0, 3)] = rng.choice(synthetic_words, size=rng.randint(0, 4))
+        content = u' '.join(words)
+        timestamp = opening - datetime.timedelta(seconds=int(seconds[n_revisions - 1 - k]))
+        rev = { 'revid': k + 1,
+                'timestamp': timestamp.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'size': len(content.encode('utf-8')),
+                'comment': '',
+                '*': content }
+        if rng.rand() > 0.05:   # the rest have their user hidden
+            rev['user'] = 'User %d' % rng.randint(0, 10)
+        if rng.rand() < 0.3:
+            rev['minor'] = ''
+        revisions.append(rev)
+    return revisions[::-1]
+
+def write_synthetic_revisions(films, output_dir, n_revisions=20, article_words=300):
+    '''
+    Writes synthetic_revisions() of each of films into output_dir, as the 
+    per-film revision files film_revision_scrape() writes with store=False. 
+    '''
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    for (k, film_i) in enumerate(films.index):
+        film = films.ix[film_i]
+        revisions = synthetic_revisions(film, n_revisions, article_words, seed=k)
+        filename = os.path.join(output_dir, '%s.revisions' % revision_key(film['wiki_title']))
+        joblib.dump(revisions, filename)
+
+### Benchmark suite
+
+def benchmark_suite(sizes=(1000, 10000, 50000), output_file='benchmark.jsonl',
+                    data_dir='benchmark_data', metric=features.people_by_genres_jaccard,
+                    cast_size=(2, 8), n_revisions=20, article_words=300, 
+                    dense_limit=5000, verbose=False):
+    
+    '''
+    Times the feature and similarity hot paths on synthetic data for each 
+    number of films in sizes: load_wikipedia_revisions() (over all films), 
+    generate_features(), subsequence_scores() (exact and approximate), 
+    sparse_subsequence_scores() and attach_similar_revenue(). The exact 
+    subsequence_scores() returns a dense n x n dataframe and scores every 
+    pair in the date window in Python, so it is skipped (and recorded as 
+    such) above dense_limit films. Synthetic revisions are written to 
+    data_dir and reused by later runs with the same settings. 
+    
+    Appends one JSON line per run to output_file, with the environment, the
+    settings and a list of { 'n', 'function', 'seconds' } results (seconds
+    None if skipped), so that runs can be compared over time; also returns 
+    the results as a dataframe. 
+    '''
+    
+    settings = { 'sizes': list(sizes), 'metric': metric.__name__, 
+                 'cast_size': list(cast_size), 'n_revisions': n_revisions, 
+                 'article_words': article_words, 'dense_limit': dense_limit }
+    results = []
+    def record(n, function, seconds, note=None):
+        results.append({ 'n': n, 'function': function, 'seconds': seconds, 'note': note })
+        if verbose:
+            print('%6d films  %-32s %s' % (n, function, 'skipped (%s)' % note if seconds is None 
+                                           else '%.3f s' % seconds))
+    
+    for n in sizes:
+        films = synthetic_films(n, cast_size=cast_size)
+        output_dir = os.path.join(data_dir, '%d' % n)
+        data_settings = { 'cast_size': list(cast_size), 'n_revisions': n_revisions, 
+                          'article_words': article_words }
+        settings_file = os.path.join(output_dir, 'settings.json')
+        if not (os.path.isfile(settings_file) and 
+                json.loads(open(settings_file, 'r').read()) == data_settings):
+            if verbose:
+                print('Writing synthetic revisions for %d films...' % n)
+            write_synthetic_revisions(films, output_dir, n_revisions, article_words)
+            with open(settings_file, 'w') as f:
+                f.write(json.dumps(data_settings))
+        
+        start = time.time()
+        for film_i in films.index:
+            load_wikipedia_revisions(films.ix[film_i], output_dir)
+        record(n, 'load_wikipedia_revisions', time.time() - start)
+        
+        start = time.time()
+        (base_features, response) = features.generate_features(films, output_dir)
+        record(n, 'generate_features', time.time() - start)
+        
+        if n <= dense_limit:
+            start = time.time()
+            subsequence = features.subsequence_scores(films, metric)
+            record(n, 'subsequence_scores', time.time() - start)
+            start = time.time()
+            features.attach_similar_revenue(films, base_features, subsequence)
+            record(n, 'attach_similar_revenue_dense', time.time() - start)
+        else:
+            note = 'over dense_limit of %d films' % dense_limit
+            record(n, 'subsequence_scores', None, note)
+            record(n, 'attach_similar_revenue_dense', None, note)
+        
+        start = time.time()
+        features.subsequence_scores(films, metric, approximate=True)
+        record(n, 'subsequence_scores_approximate', time.time() - start)
+        
+        start = time.time()
+        subsequence = features.sparse_subsequence_scores(films, metric)
+        record(n, 'sparse_subsequence_scores', time.time() - start)
+        
+        start = time.time()
+        features.attach_similar_revenue(films, base_features, subsequence)
+        record(n, 'attach_similar_revenue', time.time() - start)
+    
+    run = { 'time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'environment': { 'python': platform.python_version(),
+                             'platform': platform.platform(),
+                             'numpy': np.__version__,
+                             'scipy': scipy.__version__,
+                             'pandas': pd.__version__ },
+            'settings': settings,
+            'results': results }
+    with open(output_file, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+    return pd.DataFrame(results, columns=['n', 'function', 'seconds', 'note'])
+
+if __name__ == '__main__':
+    
+    # python benchmark.py synthetic [sizes...] runs benchmark_suite(); 
+    # otherwise compares approximate and exact scores on films.csv
+    if len(sys.argv) > 1 and sys.argv[1] == 'synthetic':
+        sizes = [int(x) for x in sys.argv[2:]] or [1000, 10000, 50000]
+        print(benchmark_suite(sizes, verbose=True))
+    else:
+        films = retrieval.read_film_csv('films.csv')
+        print(approximate_subsequence_benchmark(films, features.people_by_genres_jaccard,
+                                                verbose=True))
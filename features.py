@@ -1,12 +1,17 @@
 from bs4 import BeautifulSoup
-from retrieval.wikipedia import load_wikipedia_revisions
+from retrieval.revisionstore import common_affixes, epoch_ordinal, parse_timestamps, revision_key
+from retrieval.utilities import RateLimiter
+from retrieval.wikipedia import film_revision_updates, load_wikipedia_revision_view, revision_fingerprint, wikipedia_api_url
+import bisect
 import datetime
 import hashlib
 import joblib
+import multiprocessing
 import numpy as np
 import os.path
 import pandas as pd
 import re
+import scipy.sparse as sparse
 import simplejson as json
 import urllib
 import urllib2
@@ -44,7 +49,65 @@ def people_by_genres_jaccard(members1, members2):
 def people_by_genres_sorensen(members1, members2):
     return (sorensen_people(members1, members2) * sorensen_genres(members1, members2)) ** 0.5
 
-def subsequence_scores(films, metric, max_days_apart=1825, verbose=False):
+def film_members(films):
+    '''
+    Returns a dict mapping each index in films to the sets of people and 
+    genres used by the similarity metrics. 
+    '''
+    members = {}
+    for (i, directors, actors, genres) in zip(films.index, films['directors'], 
+                                              films['actors'], films['genres']):
+        members[i] = { 'people': set(), 'genres': set() }
+        if pd.notnull(directors):
+            members[i]['people'] |= set([directors])  # don't split - treat directing duos as one
+        if pd.notnull(actors):
+            members[i]['people'] |= set(actors.split(','))
+        if pd.notnull(genres):
+            members[i]['genres'] |= set(genres.split(','))
+    return members
+
+def opening_days(films):
+    '''Returns films' opening dates as an array of day ordinals'''
+    return np.array([x.toordinal() for x in films['opening_date']], dtype=np.int64)
+
+def window_pairs(days, max_days_apart, subset=None):
+    '''
+    Given an array of opening days, returns positional (earlier, later) arrays
+    of every pair of films released between 1 and max_days_apart days apart, 
+    grouped by later film. Pairs are found by binary search on the sorted 
+    days, so the cost grows with the number of pairs in the window rather 
+    than with the square of the number of films. If subset is given, only 
+    pairs involving at least one of those positions are returned. 
+    '''
+    
+    days = np.asarray(days, dtype=np.int64)
+    order = np.argsort(days, kind='mergesort')
+    sorted_days = days[order]
+    
+    def expand(targets, lo, hi):
+        counts = hi - lo
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return (np.repeat(targets, counts), order[np.repeat(lo, counts) + offsets])
+    
+    targets = order if subset is None else np.asarray(subset, dtype=np.int64)
+    lo = np.searchsorted(sorted_days, days[targets] - max_days_apart, side='left')
+    hi = np.searchsorted(sorted_days, days[targets], side='left')
+    (later, earlier) = expand(targets, lo, hi)
+    
+    if subset is not None:
+        # also the films released after the subset, skipping ones that are
+        # themselves in the subset (already found above)
+        lo = np.searchsorted(sorted_days, days[targets], side='right')
+        hi = np.searchsorted(sorted_days, days[targets] + max_days_apart, side='right')
+        (earlier2, later2) = expand(targets, lo, hi)
+        outside = np.logical_not(np.in1d(later2, targets))
+        earlier = np.concatenate([earlier, earlier2[outside]])
+        later = np.concatenate([later, later2[outside]])
+    
+    return (earlier, later)
+
+def subsequence_scores(films, metric, max_days_apart=1825, approximate=False,
+                       num_perm=128, bands=64, dense=False, verbose=False):
     
     '''
     Calculates subsequence scores (similarity scores, but one-way; films have 0
@@ -52,51 +115,435 @@ def subsequence_scores(films, metric, max_days_apart=1825, verbose=False):
     the films dataframe. Returns a square matrix dataframe of subsequence 
     scores. Feature calculation for film i should use the films whose rows in
     column i have with nonzero scores. 
+    
+    If approximate is True, only the pairs that MinHash/LSH finds likely to 
+    share people or genres are scored (see lsh_window_pairs() for num_perm
+    and bands), with the vectorized kernels if metric is in sparse_metrics; 
+    the rest are left at 0. The scores are then returned as a scipy.sparse 
+    matrix, as sparse_subsequence_scores() does, or as the dataframe if 
+    dense is True. 
     '''
     
     if verbose:
-        print('Calculating one=way similarities...')
-    # film in column i receives films in rows j as an input
-    scores = pd.DataFrame(index=films.index, columns=films.index)
+        print('Calculating one-way similarities...')
+    members = film_members(films)
+    index = films.index
     
-    members = {}
-    for i in films.index:
-        film = films.ix[i]
-        members[i] = { 'people': set(), 'genres': set() }
-        if pd.notnull(film['directors']):
-            members[i]['people'] |= set([film['directors']])  # don't split - treat directing duos as one
-        if pd.notnull(film['actors']):
-            members[i]['people'] |= set(film['actors'].split(','))
-        if pd.notnull(film['genres']):
-            members[i]['genres'] |= set(film['genres'].split(','))
-    
-    for i in range(len(films.index)):
-        
-        film1 = films.ix[films.index[i]]
-        if verbose:
-            print(film1['title'])
-        
-        for j in range(i, len(films.index)):
-            
-            film2 = films.ix[films.index[j]]
-            members1 = members[i]
-            members2 = members[j]
-            
-            datediff = film1['opening_date'] - film2['opening_date']
-            if abs(datediff.days) > max_days_apart or datediff.days == 0:
-                scores[i][j] = 0
-                scores[j][i] = 0
-            else: 
-                score = metric(members1, members2)
-                if datediff.days > 0:
-                    scores[i][j] = score
-                    scores[j][i] = 0
-                else:
-                    scores[j][i] = score
-                    scores[i][j] = 0
+    # film in column i receives films in rows j as an input; only pairs
+    # released within max_days_apart of each other are ever generated
+    if approximate:
+        (earlier, later) = lsh_window_pairs(films, max_days_apart, num_perm=num_perm,
+                                            bands=bands, members=members)
+        if metric in sparse_metrics:
+            score = kernel_pair_scores(films, metric, earlier, later, members=members)
+        else:
+            score = pair_scores(films, metric, earlier, later, members, verbose=verbose)
+        nonzero = score > 0
+        scores = sparse.coo_matrix((score[nonzero], (earlier[nonzero], later[nonzero])),
+                                   shape=(len(index), len(index))).tocsc()
+        if dense:
+            return pd.DataFrame(scores.toarray(), index=index, columns=index)
+        return scores
+    
+    (earlier, later) = window_pairs(opening_days(films), max_days_apart)
+    scores = np.zeros((len(index), len(index)))
+    scores[earlier, later] = pair_scores(films, metric, earlier, later, members, verbose=verbose)
+    return pd.DataFrame(scores, index=index, columns=index)
+
+def pair_scores(films, metric, earlier, later, members, verbose=False):
+    '''
+    Returns an array of metric scores for the (earlier, later) positional 
+    pairs of films, with members as returned by film_members(). 
+    '''
+    index = films.index
+    scores = np.zeros(len(later))
+    for k in range(len(later)):
+        (j, i) = (earlier[k], later[k])
+        if verbose and (k == 0 or later[k-1] != i):
+            print(films['title'][index[i]])
+        # metric gets the films in index order, as it always has
+        (first, second) = (min(i, j), max(i, j))
+        scores[k] = metric(members[index[first]], members[index[second]])
+    return scores
+
+def film_fingerprints(films, members=None):
+    '''
+    Returns a list of strings identifying each film and everything about it
+    that the similarity metrics can see (title, year, opening date, people
+    and genres). 
+    '''
+    if members is None:
+        members = film_members(films)
+    fingerprints = []
+    for (i, title, year, opening_date) in zip(films.index, films['title'], films['year'],
+                                              films['opening_date']):
+        parts = [title, str(year), opening_date.isoformat(),
+                 '|'.join(sorted(members[i]['people'])), 
+                 '|'.join(sorted(members[i]['genres']))]
+        fingerprints.append(hashlib.md5(u'\n'.join(parts).encode('utf-8')).hexdigest())
+    return fingerprints
+
+def _occurrences(fingerprints):
+    '''Pairs each fingerprint with how many times it came up before.'''
+    seen = {}
+    keys = []
+    for x in fingerprints:
+        keys.append((x, seen.get(x, 0)))
+        seen[x] = seen.get(x, 0) + 1
+    return keys
+
+def cached_subsequence_scores(films, metric, filename, max_days_apart=1825,
+                              dense=False, verbose=False):
+    
+    '''
+    Same scores as subsequence_scores(), but kept in filename (a joblib 
+    pickle recording the metric name and max_days_apart alongside the score
+    matrix) and updated incrementally: films already scored in a previous 
+    run are reused, and only the rows and columns of new or changed films 
+    are computed, with the sparse engine for the metrics in sparse_metrics. 
+    Films no longer present are dropped. The stored scores are 
+    recomputed from scratch if the metric or max_days_apart differ. Returns 
+    a scipy.sparse matrix in the order of films.index, or a dataframe if 
+    dense is True. 
+    '''
+    
+    members = film_members(films)
+    fingerprints = film_fingerprints(films, members=members)
+    n = len(films.index)
+    
+    stored = None
+    if os.path.isfile(filename):
+        stored = joblib.load(filename)
+        if stored['metric'] != metric.__name__ or stored['max_days_apart'] != max_days_apart:
+            if verbose:
+                print('Stored scores are for %s / %d days, recomputing' % (stored['metric'], 
+                                                                          stored['max_days_apart']))
+            stored = None
+    
+    if stored is None:
+        old_rows = old_cols = np.array([], dtype=np.int64)
+        old_data = np.array([])
+        stale = None
+    else:
+        # map the stored films onto their current positions, -1 if gone;
+        # identical films share a fingerprint, so match them up in order
+        position = dict((x, k) for (k, x) in enumerate(_occurrences(fingerprints)))
+        moved = np.array([position.get(x, -1) for x in _occurrences(stored['fingerprints'])], 
+                         dtype=np.int64)
+        old = stored['scores'].tocoo()
+        (old_rows, old_cols) = (moved[old.row], moved[old.col])
+        present = np.logical_and(old_rows >= 0, old_cols >= 0)
+        (old_rows, old_cols, old_data) = (old_rows[present], old_cols[present], old.data[present])
+        stale = np.setdiff1d(np.arange(n), moved)
+    
+    if verbose:
+        print('Calculating one-way similarities for %d of %d films...' % 
+              (n if stale is None else len(stale), n))
+    if stale is not None and len(stale) == 0:
+        (earlier, later) = (np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+        new_data = np.array([])
+    elif metric in sparse_metrics:
+        (earlier, later, new_data) = sparse_pair_scores(films, metric, max_days_apart, subset=stale)
+    else:
+        (earlier, later) = window_pairs(opening_days(films), max_days_apart, subset=stale)
+        new_data = pair_scores(films, metric, earlier, later, members, verbose=verbose)
+        nonzero = new_data > 0
+        (earlier, later, new_data) = (earlier[nonzero], later[nonzero], new_data[nonzero])
+    
+    scores = sparse.coo_matrix((np.concatenate([old_data, new_data]),
+                                (np.concatenate([old_rows, earlier]),
+                                 np.concatenate([old_cols, later]))),
+                               shape=(n, n)).tocsc()
+    joblib.dump({ 'metric': metric.__name__,
+                  'max_days_apart': max_days_apart,
+                  'fingerprints': fingerprints,
+                  'scores': scores }, filename)
+    
+    if dense:
+        return pd.DataFrame(scores.toarray(), index=films.index, columns=films.index)
+    return scores
+
+def subsequence_score_columns(films, metric, index=None, filename=None, 
+                              max_days_apart=1825):
+    
+    '''
+    Read-only counterpart of cached_subsequence_scores() for scoring a few 
+    films: returns a scipy.sparse matrix in the order of films.index with 
+    only the columns of the films with labels in index (all of them if 
+    None) filled in, which is all that attach_similar_revenue() reads for 
+    them. Columns stored in filename (if given, and for the same metric and 
+    max_days_apart) are reused, and only the pairs with films new since then 
+    are scored; filename itself is never written. 
+    '''
+    
+    members = film_members(films)
+    fingerprints = film_fingerprints(films, members=members)
+    n = len(films.index)
+    if index is None:
+        targets = np.arange(n)
+    else:
+        targets = films.index.get_indexer(index)
+        if (targets < 0).any():
+            raise KeyError('Error: films to score missing from films')
+    
+    stored = None
+    if filename is not None and os.path.isfile(filename):
+        stored = joblib.load(filename, mmap_mode='r')
+        if stored['metric'] != metric.__name__ or stored['max_days_apart'] != max_days_apart:
+            stored = None
+    
+    if stored is None:
+        (old_rows, old_cols, old_data) = (np.array([], dtype=np.int64), 
+                                          np.array([], dtype=np.int64), np.array([]))
+        subset = targets
+    else:
+        keys = _occurrences(fingerprints)
+        stored_position = dict((x, k) for (k, x) in enumerate(_occurrences(stored['fingerprints'])))
+        moved = np.array([stored_position.get(x, -1) for x in keys], dtype=np.int64)
+        position = dict((x, k) for (k, x) in enumerate(keys))
+        stored_moved = np.array([position.get(x, -1) for x in _occurrences(stored['fingerprints'])],
+                                dtype=np.int64)
+        found = targets[moved[targets] >= 0]
+        old = sparse.csc_matrix(stored['scores'])[:, moved[found]].tocoo()
+        (old_rows, old_cols) = (stored_moved[old.row], found[old.col])
+        present = old_rows >= 0
+        (old_rows, old_cols, old_data) = (old_rows[present], old_cols[present], old.data[present])
+        # what the stored columns lack: pairs with films stored since
+        subset = np.flatnonzero(moved < 0)
+    
+    if len(subset) == 0:
+        (earlier, later, new_data) = (np.array([], dtype=np.int64), 
+                                      np.array([], dtype=np.int64), np.array([]))
+    elif metric in sparse_metrics:
+        (earlier, later, new_data) = sparse_pair_scores(films, metric, max_days_apart, subset=subset)
+    else:
+        (earlier, later) = window_pairs(opening_days(films), max_days_apart, subset=subset)
+        wanted = np.in1d(later, targets)
+        (earlier, later) = (earlier[wanted], later[wanted])
+        new_data = pair_scores(films, metric, earlier, later, members)
+    wanted = np.logical_and(np.in1d(later, targets), new_data > 0)
+    
+    return sparse.coo_matrix((np.concatenate([old_data, new_data[wanted]]),
+                              (np.concatenate([old_rows, earlier[wanted]]),
+                               np.concatenate([old_cols, later[wanted]]))),
+                             shape=(n, n)).tocsc()
+
+### Approximate candidate generation - MinHash signatures over films' people
+### and genres, bucketed with locality-sensitive hashing
+
+_minhash_prime = (1 << 31) - 1
+
+def minhash_signatures(films, num_perm=128, keys=('people', 'genres'), seed=0,
+                       members=None, chunk_size=16):
+    
+    '''
+    Returns a num_perm x len(films) array of MinHash signatures of the union
+    of each film's member sets in keys. Films with no members get the 
+    sentinel value _minhash_prime in every row. 
+    '''
+    
+    incidence = incidence_matrices(films, members=members)
+    matrix = sparse.hstack([incidence[key] for key in keys]).tocsr()
+    nonempty = np.diff(matrix.indptr) > 0
+    starts = matrix.indptr[:-1][nonempty]
+    tokens = np.arange(matrix.shape[1], dtype=np.int64)
+    
+    random_state = np.random.RandomState(seed)
+    a = random_state.randint(1, _minhash_prime, size=num_perm).astype(np.int64)
+    b = random_state.randint(0, _minhash_prime, size=num_perm).astype(np.int64)
+    
+    signatures = np.empty((num_perm, matrix.shape[0]), dtype=np.int64)
+    signatures.fill(_minhash_prime)
+    if len(starts) == 0:
+        return signatures
+    for k in range(0, num_perm, chunk_size):
+        hashes = (a[k:k+chunk_size, np.newaxis] * tokens + b[k:k+chunk_size, np.newaxis]) % _minhash_prime
+        signatures[k:k+chunk_size, nonempty] = np.minimum.reduceat(hashes[:, matrix.indices], 
+                                                                   starts, axis=1)
+    return signatures
+
+def lsh_window_pairs(films, max_days_apart, num_perm=128, bands=64, seed=0,
+                     members=None):
+    
+    '''
+    Same as window_pairs(), but only returns the pairs whose MinHash 
+    signatures agree in at least one of bands bands of num_perm / bands rows.
+    A pair whose people/genre Jaccard similarity is s is found with 
+    probability 1 - (1 - s^r)^b for r rows and b bands, so more bands (fewer 
+    rows each) raise recall at the cost of scoring more pairs, and more 
+    permutations sharpen the cutoff. 
+    '''
+    
+    if num_perm % bands != 0:
+        raise Exception('Error: num_perm (%d) must be a multiple of bands (%d)' % (num_perm, bands))
+    rows = num_perm // bands
+    signatures = minhash_signatures(films, num_perm=num_perm, seed=seed, members=members)
+    n = signatures.shape[1]
+    candidates = np.arange(n)[signatures[0] != _minhash_prime]
+    multipliers = np.random.RandomState(seed + 1).randint(1, _minhash_prime, size=rows).astype(np.int64) | 1
+    days = opening_days(films)
+    
+    codes = []
+    for band in range(bands):
+        # collapse each film's rows in the band into one bucket key
+        keys = np.dot(multipliers, signatures[band*rows:(band+1)*rows, candidates])
+        order = np.argsort(keys, kind='mergesort')
+        sorted_keys = keys[order]
+        boundaries = np.flatnonzero(np.diff(sorted_keys)) + 1
+        band_codes = []
+        for bucket in np.split(candidates[order], boundaries):
+            if len(bucket) > 1:
+                # only the pairs within the date window, so a big bucket 
+                # costs its in-window pairs rather than all of its pairs
+                (first, second) = window_pairs(days[bucket], max_days_apart)
+                band_codes.append(bucket[first].astype(np.int64) * n + bucket[second])
+        if len(band_codes) > 0:
+            codes.append(np.unique(np.concatenate(band_codes)))
+    if len(codes) == 0:
+        return (np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+    codes = np.unique(np.concatenate(codes))
+    
+    (earlier, later) = (codes // n, codes % n)
+    order = np.lexsort((earlier, later))
+    return (earlier[order], later[order])
+
+### Sparse similarity engine - vectorized equivalents of the metrics above,
+### used by sparse_subsequence_scores()
+
+def _jaccard(common, size1, size2):
+    combined = (size1 + size2 - common).astype(float)
+    return np.where(combined == 0, 0, common / np.maximum(combined, 1))
+
+def _sorensen(common, size1, size2):
+    denom = (size1 + size2).astype(float)
+    return np.where(denom == 0, 0, 2 * common / np.maximum(denom, 1))
+
+# Each metric maps to the (member set, kernel) components it is built from; 
+# the score is the geometric mean of the components. All of them are zero
+# unless the first component's sets intersect, which is what lets 
+# sparse_subsequence_scores() only look at overlapping pairs. 
+sparse_metrics = { jaccard_people: [('people', _jaccard)],
+                   jaccard_genres: [('genres', _jaccard)],
+                   sorensen_people: [('people', _sorensen)],
+                   sorensen_genres: [('genres', _sorensen)],
+                   people_by_genres_jaccard: [('people', _jaccard), ('genres', _jaccard)],
+                   people_by_genres_sorensen: [('people', _sorensen), ('genres', _sorensen)],
+                 }
+
+def incidence_matrices(films, members=None):
+    '''
+    Returns a dict with sparse 0/1 film x person and film x genre incidence 
+    matrices (under 'people' and 'genres'), rows in the order of films.index. 
+    '''
+    if members is None:
+        members = film_members(films)
+    matrices = {}
+    for key in ('people', 'genres'):
+        vocabulary = {}
+        indptr = [0]
+        indices = []
+        for i in films.index:
+            for member in members[i][key]:
+                indices.append(vocabulary.setdefault(member, len(vocabulary)))
+            indptr.append(len(indices))
+        data = np.ones(len(indices))
+        matrices[key] = sparse.csr_matrix((data, indices, indptr), 
+                                          shape=(len(films.index), len(vocabulary)))
+    return matrices
+
+def sparse_subsequence_scores(films, metric, max_days_apart=1825, dense=False,
+                              verbose=False):
+    
+    '''
+    Vectorized version of subsequence_scores() for the metrics in 
+    sparse_metrics. Intersection sizes come from sparse products of the 
+    people/genre incidence matrices, so only pairs of films sharing members 
+    are ever scored. Returns a scipy.sparse matrix (rows and columns in the 
+    order of films.index, film in column i receives films in rows j), or the 
+    same dataframe subsequence_scores() would return if dense is True. 
+    '''
     
+    if metric not in sparse_metrics:
+        raise Exception('Error: no sparse implementation of metric %s' % metric.__name__)
+    
+    if verbose:
+        print('Calculating one-way similarities (sparse)...')
+    n = len(films.index)
+    (rows, cols, score) = sparse_pair_scores(films, metric, max_days_apart)
+    scores = sparse.coo_matrix((score, (rows, cols)), shape=(n, n)).tocsc()
+    if dense:
+        return pd.DataFrame(scores.toarray(), index=films.index, columns=films.index)
     return scores
 
+def sparse_pair_scores(films, metric, max_days_apart=1825, subset=None):
+    
+    '''
+    The nonzero scores found by sparse_subsequence_scores(), as positional
+    (earlier, later, score) arrays. If subset (an array of positions) is 
+    given, only the pairs involving at least one of those films are scored,
+    as window_pairs() does for subsequence_scores(). 
+    '''
+    
+    components = sparse_metrics[metric]
+    incidence = incidence_matrices(films)
+    days = opening_days(films)
+    
+    first = incidence[components[0][0]]
+    first_sizes = np.asarray(first.sum(axis=1)).ravel()
+    if subset is None:
+        overlap = (first * first.T).tocoo()
+        (rows, cols, common) = (overlap.row, overlap.col, overlap.data)
+    else:
+        subset = np.asarray(subset, dtype=np.int64)
+        overlap = (first[subset] * first.T).tocoo()
+        (a, b) = (subset[overlap.row], overlap.col)
+        # put the earlier film first; a pair of two films in subset is 
+        # found from both, so keep it only from the later one's row
+        a_first = days[a] < days[b]
+        keep = np.logical_or(np.logical_not(np.in1d(b, subset)), np.logical_not(a_first))
+        rows = np.where(a_first, a, b)[keep]
+        cols = np.where(a_first, b, a)[keep]
+        common = overlap.data[keep]
+    datediff = days[cols] - days[rows]
+    keep = np.logical_and(datediff > 0, datediff <= max_days_apart)
+    rows = rows[keep]
+    cols = cols[keep]
+    
+    score = components[0][1](common[keep], first_sizes[rows], first_sizes[cols])
+    if len(components) > 1:
+        score = score * _component_scores(incidence, components[1:], rows, cols)
+        score = score ** (1.0 / len(components))
+    
+    nonzero = score > 0
+    return (rows[nonzero].astype(np.int64), cols[nonzero].astype(np.int64), score[nonzero])
+
+def kernel_pair_scores(films, metric, earlier, later, members=None):
+    '''
+    Vectorized pair_scores() for the metrics in sparse_metrics: returns an 
+    array of metric scores for the (earlier, later) positional pairs. 
+    '''
+    components = sparse_metrics[metric]
+    incidence = incidence_matrices(films, members=members)
+    score = _component_scores(incidence, components, earlier, later)
+    if len(components) > 1:
+        score = score ** (1.0 / len(components))
+    return score
+
+def _component_scores(incidence, components, rows, cols, chunk_size=2**20):
+    '''
+    Product of the components' kernels over the (rows, cols) pairs, 
+    chunk_size pairs at a time to bound the size of the row products. 
+    '''
+    score = np.ones(len(rows))
+    for (key, kernel) in components:
+        matrix = incidence[key]
+        sizes = np.asarray(matrix.sum(axis=1)).ravel()
+        for start in range(0, len(rows), chunk_size):
+            (r, c) = (rows[start:start + chunk_size], cols[start:start + chunk_size])
+            common = np.asarray(matrix[r].multiply(matrix[c]).sum(axis=1)).ravel()
+            score[start:start + chunk_size] *= kernel(common, sizes[r], sizes[c])
+    return score
+
 def print_similar_past(films, film_index, scores):
     '''Small utility function to print a film's antecedents'''
     for j in films.index:
@@ -105,19 +552,363 @@ def print_similar_past(films, film_index, scores):
                                            films.ix[j]['title'][:30], 
                                            scores[film_index][j]))
 
+### Text features - regular expression counts over each revision's lowercased
+### wikitext. Consecutive revisions are nearly identical, so after the first
+### one only the region that changed is rescanned. 
+
+# (feature, pattern, width): patterns with a width can't produce overlapping
+# matches, so their count is the number of positions where they match and
+# only the positions within width of a change need rescanning. The others
+# never match across a line break, so only the changed lines need rescanning. 
+text_features = [('word_imax', re.compile(r'\Wimax'), 5),
+                 ('word_extfile', re.compile(r'File:.*|'), None),
+                 ('word_headings', re.compile(r'==.*=='), None)]
+
+def _region_count(pattern, width, text, start, end):
+    '''
+    Count of pattern's matches attributable to text[start:end], with start 
+    and end already expanded as needed for the pattern. 
+    '''
+    count = len(pattern.findall(text, start, end))
+    if width is None and pattern.match('') is not None:
+        count -= 1  # the empty match at the end belongs to the next line
+    return count
+
+def text_feature_counts(contents, previous=None, counts=None):
+    
+    '''
+    Given an iterable of revision wikitexts (None for revisions without 
+    content), yields a list of counts per revision, one for each pattern in 
+    text_features, exactly as a full rescan of every lowercased revision 
+    would. Each revision is compared with the last one that had content, and
+    only the changed region is rescanned. To carry on from an earlier scan,
+    pass the lowercased wikitext and counts of the last revision with 
+    content before contents as previous and counts. 
+    '''
+    
+    if counts is not None:
+        counts = list(counts)
+    for content in contents:
+        if content is None:
+            yield [0] * len(text_features)
+            continue
+        content = content.lower()
+        if previous is None:
+            counts = [len(pattern.findall(content)) for (name, pattern, width) in text_features]
+        elif content != previous:
+            (prefix, suffix) = common_affixes(previous, content)
+            line_start = previous.rfind('\n', 0, prefix) + 1
+            ends = []
+            for text in (previous, content):
+                line_end = text.find('\n', len(text) - suffix)
+                ends.append(len(text) if line_end < 0 else line_end + 1)
+            for (k, (name, pattern, width)) in enumerate(text_features):
+                if width is None:
+                    (start, old_end, new_end) = (line_start, ends[0], ends[1])
+                else:
+                    start = max(0, prefix - width + 1)
+                    old_end = len(previous) - suffix + width - 1
+                    new_end = len(content) - suffix + width - 1
+                counts[k] += (_region_count(pattern, width, content, start, new_end) - 
+                              _region_count(pattern, width, previous, start, old_end))
+        previous = content
+        yield list(counts)
+
 ### Feature generation
 
-def generate_features(films, output_dir, add_const=False, verbose=False):
+# Bump feature_version whenever film_features() changes what it computes, so
+# that cached features from older code are not reused. 
+feature_version = 2
+
+class FeatureCache(object):
+    
+    '''
+    On-disk cache of film_features() results in directory path, one joblib 
+    file per entry, keyed by the hash of the film's revision data, the film 
+    fields the features read, the feature settings and feature_version. 
+    Counts hits and misses. If max_entries or max_bytes are given, evict() removes
+    the least recently used entries beyond those limits. 
+    '''
+    
+    def __init__(self, path, max_entries=None, max_bytes=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    
+    def key(self, film, output_dir, settings=()):
+        '''Returns the cache key for film's features under settings.'''
+        parts = [revision_fingerprint(film, output_dir), film['wiki_title'], 
+                 film['genres'], film['mpaa_rating'], film['opening_date'],
+                 settings, feature_version]
+        return hashlib.md5(u'\n'.join(u'%s' % (x,) for x in parts).encode('utf-8')).hexdigest()
+    
+    def _filename(self, key):
+        return os.path.join(self.path, '%s.features' % key)
+    
+    def get(self, key):
+        '''Returns the cached features for key, or None.'''
+        filename = self._filename(key)
+        if not os.path.isfile(filename):
+            self.misses += 1
+            return None
+        self.hits += 1
+        os.utime(filename, None)  # mark as recently used
+        return joblib.load(filename)
+    
+    def put(self, key, values):
+        filename = self._filename(key)
+        joblib.dump(values, filename + '.tmp')
+        os.rename(filename + '.tmp', filename)
+    
+    def evict(self):
+        '''Removes least recently used entries until within the size limits.'''
+        entries = []
+        for x in os.listdir(self.path):
+            if x.endswith('.features'):
+                stat = os.stat(os.path.join(self.path, x))
+                entries.append((stat.st_mtime, stat.st_size, x))
+        entries.sort(reverse=True)
+        (count, total) = (0, 0)
+        for (mtime, size, x) in entries:
+            count += 1
+            total += size
+            if ((self.max_entries is not None and count > self.max_entries) or
+                (self.max_bytes is not None and total > self.max_bytes)):
+                os.remove(os.path.join(self.path, x))
+    
+    def __repr__(self):
+        return 'FeatureCache(%s, %d hits, %d misses)' % (self.path, self.hits, self.misses)
+
+edit_activity_kinds = ('edit_runs', 'editors', 'bytes_added', 'minor_edits', 'major_edits')
+
+def edit_activity_names(horizons, kinds):
+    '''Feature names produced by edit_activity() for horizons and kinds.'''
+    return ['%s_%d_%d' % (kind, horizons[k-1], horizons[k]) 
+            for kind in kinds for k in range(1, len(horizons))]
+
+def edit_activity(revisions, opening_date, horizons=(0, 7, 28), kinds=edit_activity_kinds):
+    
+    '''
+    Edit-activity features of a film's revisions (a FilmRevisions view) for
+    every window between consecutive day boundaries in horizons, computed 
+    together from the revision arrays. A revision is in window (lo, hi] if 
+    it was made lo < d <= hi days before opening_date, except that the first
+    window also takes everything more recent. Returns a dict with, per 
+    window, any of:
+    
+    edit_runs: strings of consecutive edits by the same user, counted in 
+               the window of their most recent edit
+    editors: distinct (visible) users
+    bytes_added: total size increase over the previous stored revision
+    minor_edits / major_edits: edits flagged minor or not
+    '''
+    
+    windows = len(horizons) - 1
+    days = revisions.days_before(opening_date)
+    window = np.searchsorted(np.asarray(horizons[1:]), days, side='left')
+    inside = window < windows
+    def per_window(mask, weights=None):
+        w = None if weights is None else weights[np.logical_and(mask, inside)]
+        return np.bincount(window[np.logical_and(mask, inside)], weights=w, 
+                           minlength=windows)[:windows]
+    
+    totals = {}
+    user = np.asarray(revisions.user)
+    if 'edit_runs' in kinds:
+        # revisions are newest first, so a run starts where the user changes
+        starts = np.ones(len(user), dtype=bool)
+        starts[1:] = user[1:] != user[:-1]
+        totals['edit_runs'] = per_window(starts)
+    if 'editors' in kinds:
+        visible = np.logical_and(user >= 0, inside)
+        stride = int(user.max()) + 1 if len(user) > 0 else 1
+        pairs = np.unique(window[visible] * stride + user[visible])
+        totals['editors'] = np.bincount(pairs // stride, minlength=windows)[:windows]
+    if 'bytes_added' in kinds:
+        size = np.asarray(revisions.size)
+        added = np.zeros(len(size), dtype=np.int64)
+        added[:-1] = np.maximum(size[:-1] - size[1:], 0)
+        totals['bytes_added'] = per_window(np.ones(len(size), dtype=bool), added).astype(np.int64)
+    if 'minor_edits' in kinds or 'major_edits' in kinds:
+        minor = np.asarray(revisions.minor) != 0
+        totals['minor_edits'] = per_window(minor)
+        totals['major_edits'] = per_window(np.logical_not(minor))
+    
+    values = {}
+    for kind in kinds:
+        for k in range(windows):
+            values['%s_%d_%d' % (kind, horizons[k], horizons[k+1])] = totals[kind][k]
+    return values
+
+def film_features(film, output_dir, edit_horizons=(0, 7, 28), edit_kinds=('edit_runs',),
+                  verbose=False):
+    
+    '''
+    Calculates the features of a single film (a row of the films dataframe) 
+    that don't depend on other films, with edit_activity() features for 
+    edit_horizons and edit_kinds. Returns a dict of the features that were 
+    set; the rest are 0. 
+    '''
+    
+    revisions = load_wikipedia_revision_view(film, output_dir)
+    if verbose:
+        print '(%d) %s / %d revisions' % (film.name, film['wiki_title'], len(revisions))
+        
+    if film['wiki_title'] is None:
+        raise Exception('Error: no wiki_title found for film %s, index %i' % (film['title'], film.name))
+    
+    values = film_field_features(film)
+    
+    # Revision-based features
+    
+    values.update(edit_activity(revisions, film['opening_date'], 
+                                horizons=edit_horizons, kinds=edit_kinds))
+    
+    # only the content of each revision is read from disk here; the
+    # metadata above never touches it
+    contents = (revisions.content(j) for j in range(len(revisions)))
+    word_counts = np.array(list(text_feature_counts(contents)), dtype=int)
+    if revisions.content_sample is not None:
+        # only the sampled revisions have content, so average over those
+        word_counts = word_counts[revisions.content_offset >= 0]
+    
+    if len(word_counts) > 0:
+        for (k, (name, pattern, width)) in enumerate(text_features):
+            values[name] = word_counts[:, k].mean()
+    values['avg_size'] = revisions.size.mean()
+    
+    return values
+
+def film_field_features(film):
     
     '''
-    For data in films, calculates all 
+    The features of film that come from its fields in the films dataframe 
+    alone (genres, rating, release day), as a dict of those set to 1. 
+    '''
+    
+    values = {}
+    
+    # Genre indicators
+    
+    if not pd.isnull(film['genres']):
+        genres = set(film['genres'].split(','))
+        if 'Action & Adventure' in genres:
+            values['genre_action'] = 1
+        if 'Animation' in genres:
+            values['genre_animation'] = 1
+        if 'Art House & International' in genres:
+            values['genre_arthouse'] = 1
+        if 'Classics' in genres:
+            values['genre_classics'] = 1
+        if 'Comedy' in genres:
+            values['genre_comedy'] = 1
+        if 'Cult Movies' in genres:
+            values['genre_cult'] = 1
+        if 'Documentary' in genres:
+            values['genre_documentary'] = 1
+        if 'Drama' in genres:
+            values['genre_drama'] = 1
+        if 'Horror' in genres:
+            values['genre_horror'] = 1
+        if 'Kids & Family' in genres:
+            values['genre_kids'] = 1
+        if 'Musical & Performing Arts' in genres:
+            values['genre_musical'] = 1
+        if 'Mystery & Suspense' in genres:
+            values['genre_mystery'] = 1
+        if 'Romance' in genres:
+            values['genre_romance'] = 1
+        if 'Science Fiction & Fantasy' in genres:
+            values['genre_scifi'] = 1
+        if 'Special Interest' in genres:
+            values['genre_special'] = 1
+        if 'Sports & Fitness' in genres:
+            values['genre_sports'] = 1
+        if 'Television' in genres:
+            values['genre_tv'] = 1
+        if 'Western' in genres:
+            values['genre_western'] = 1
+    
+    # only a very few films unrated, so anything not in the above 3 buckets gets to be "R or UR"
+    
+    if film['mpaa_rating'] == 'G':
+        values['mpaa_g'] = 1
+    elif film['mpaa_rating'] == 'PG':
+        values['mpaa_pg'] = 1
+    elif film['mpaa_rating'] == 'PG-13':
+        values['mpaa_pg13'] = 1
+    
+    if film['opening_date'].weekday() == 5:
+        values['release_friday'] = 1
+    
+    return values
+
+def _film_features_star(args):
+    return film_features(*args)
+
+def generate_features(films, output_dir, add_const=False, n_jobs=1, cache=None,
+                      edit_horizons=(0, 7, 28), edit_kinds=('edit_runs',), verbose=False):
+    
+    '''
+    For data in films, calculates all the features that don't depend on other
+    films, using n_jobs worker processes (-1 for one per CPU). If cache (a 
+    FeatureCache) is given, films whose revisions and fields are unchanged 
+    are served from it and only the rest are recomputed. Edit-activity 
+    features are computed for every window in edit_horizons and every kind
+    in edit_kinds (see edit_activity()), so several horizons can be tried 
+    in one run. 
+    '''
+    
+    n = len(films.index)
+    if n_jobs == -1:
+        n_jobs = multiprocessing.cpu_count()
+    results = [None] * n
+    if cache is not None:
+        settings = (tuple(edit_horizons), tuple(edit_kinds))
+        keys = [cache.key(films.ix[film_i], output_dir, settings) for film_i in films.index]
+        results = [cache.get(key) for key in keys]
+    stale = [i for i in range(n) if results[i] is None]
+    
+    tasks = [(films.ix[films.index[i]], output_dir, edit_horizons, edit_kinds, verbose) 
+             for i in stale]
+    if n_jobs > 1 and len(tasks) > 1:
+        # fan films out to worker processes in chunks; map() keeps the
+        # results in films.index order
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            computed = pool.map(_film_features_star, tasks, 
+                                chunksize=max(1, len(tasks) // (n_jobs * 4)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        computed = [_film_features_star(task) for task in tasks]
+    for (i, values) in zip(stale, computed):
+        results[i] = values
+        if cache is not None:
+            cache.put(keys[i], values)
+    if cache is not None:
+        cache.evict()
+        if verbose:
+            print(cache)
+    
+    return features_frame(films, results, edit_horizons, edit_kinds)
+
+def features_frame(films, results, edit_horizons=(0, 7, 28), edit_kinds=('edit_runs',)):
+    
+    '''
+    Assembles per-film feature dicts (results, in the order of films.index, as
+    returned by film_features()) into the (features, response) pair returned 
+    by generate_features(). 
     '''
     
     response = films['opening_gross'] / films['opening_theaters']
     n = len(films.index)
-    features = { 'edit_runs_7_28': [0] * n, 
-                 'edit_runs_0_7': [0] * n,
-                 'word_imax': [0] * n,
+    features = { 'word_imax': [0] * n,
                  'word_extfile': [0] * n,
                  'word_headings': [0] * n,
                  'avg_size': [0] * n,
@@ -145,105 +936,13 @@ def generate_features(films, output_dir, add_const=False, verbose=False):
                  'mpaa_pg13': [0] * n,
                  'release_friday': [0] * n,
                }
+    for name in edit_activity_names(edit_horizons, edit_kinds):
+        features[name] = [0] * n
+    
+    for (i, values) in enumerate(results):
+        for name in values:
+            features[name][i] = values[name]
     
-    for (i, film_i) in enumerate(films.index):
-        
-        film = films.ix[film_i]
-        revisions = load_wikipedia_revisions(film, output_dir)
-        if verbose:
-            print '(%d) %s / %d revisions' % (film_i, film['wiki_title'], len(revisions))
-            
-        if film['wiki_title'] is None:
-            raise Exception('Error: no wiki_title found for film %s, index %i' % (film['title'], i))
-        
-        # Genre indicators
-        
-        if not pd.isnull(film['genres']):
-            genres = set(film['genres'].split(','))
-            if 'Action & Adventure' in genres:
-                features['genre_action'][i] = 1
-            if 'Animation' in genres:
-                features['genre_animation'][i] = 1
-            if 'Art House & International' in genres:
-                features['genre_arthouse'][i] = 1
-            if 'Classics' in genres:
-                features['genre_classics'][i] = 1
-            if 'Comedy' in genres:
-                features['genre_comedy'][i] = 1
-            if 'Cult Movies' in genres:
-                features['genre_cult'][i] = 1
-            if 'Documentary' in genres:
-                features['genre_documentary'][i] = 1
-            if 'Drama' in genres:
-                features['genre_drama'][i] = 1
-            if 'Horror' in genres:
-                features['genre_horror'][i] = 1
-            if 'Kids & Family' in genres:
-                features['genre_kids'][i] = 1
-            if 'Musical & Performing Arts' in genres:
-                features['genre_musical'][i] = 1
-            if 'Mystery & Suspense' in genres:
-                features['genre_mystery'][i] = 1
-            if 'Romance' in genres:
-                features['genre_romance'][i] = 1
-            if 'Science Fiction & Fantasy' in genres:
-                features['genre_scifi'][i] = 1
-            if 'Special Interest' in genres:
-                features['genre_special'][i] = 1
-            if 'Sports & Fitness' in genres:
-                features['genre_sports'][i] = 1
-            if 'Television' in genres:
-                features['genre_tv'][i] = 1
-            if 'Western' in genres:
-                features['genre_western'][i] = 1
-        
-        # only a very few films unrated, so anything not in the above 3 buckets gets to be "R or UR"
-        
-        if film['mpaa_rating'] == 'G':
-            features['mpaa_g'][i] = 1
-        elif film['mpaa_rating'] == 'PG':
-            features['mpaa_pg'][i] = 1
-        elif film['mpaa_rating'] == 'PG-13':
-            features['mpaa_pg13'][i] = 1
-        
-        if film['opening_date'].weekday() == 5:
-            features['release_friday'][i] = 1
-        
-        # Revision-based features
-        
-        prev_editor = None
-        edit_runs_0_7 = 0    # edit run = one string of consecutive edits by
-        edit_runs_7_28 = 0   # the same author
-        for rev in revisions:
-            if rev['user'] != prev_editor:
-                daydiff = (film['opening_date'] - rev['timestamp'].date()).days
-                if daydiff <= 7:
-                    edit_runs_0_7 += 1
-                elif daydiff <= 28:
-                    edit_runs_7_28 += 1
-                prev_editor = rev['user']
-        features['edit_runs_0_7'][i] = edit_runs_0_7
-        features['edit_runs_7_28'][i] = edit_runs_7_28
-        
-        word_imax = np.array([0] * len(revisions))
-        word_extfile = np.array([0] * len(revisions))
-        word_headings = np.array([0] * len(revisions))
-        sizes = np.array([0] * len(revisions))
-        
-        for (j, rev) in enumerate(revisions):
-            if '*' in rev:
-                content = rev['*'].lower()
-                word_imax[j] = len(re.findall(r'\Wimax', content))
-                word_extfile[j] = len(re.findall(r'File:.*|', content))
-                word_headings[j] = len(re.findall(r'==.*==', content))
-            sizes[j] = rev['size']
-                    
-        if len(revisions) > 0:
-            features['word_imax'][i] = word_imax.mean()
-            features['word_extfile'][i] = word_extfile.mean()
-            features['word_headings'][i] = word_headings.mean()
-        features['avg_size'][i] = sizes.mean()
-        
     features = pd.DataFrame(features, index=films.index)
     
     features['runtime'] = films['runtime']
@@ -258,24 +957,34 @@ def attach_similar_revenue(films, features, subsequence):
     Attaches similar revenues to features (based on the subsequence scores in
     subsequence) and returns it. Separated from the rest of the feature generation 
     to make it easy to try out different similarity metrics without recalculating 
-    all the other features. 
+    all the other features. subsequence can be a dataframe as returned by 
+    subsequence_scores() or a scipy.sparse matrix in the order of films.index 
+    as returned by sparse_subsequence_scores(). 
     '''
     
-    similar_past_revenue = [0] * len(features)
-    for (i, film_i) in enumerate(features.index):
-        
-        # Similar-film revenue
-        
-        if sum(subsequence[film_i]) > 0:
-            contrib = subsequence[film_i] * films['opening_gross'] / films['opening_theaters']
-            similar_past_revenue[i] = sum(contrib) / float(sum(subsequence[film_i]))
-
+    # Similar-film revenue: per-theater revenue of each film's antecedents,
+    # weighted by their scores, all films at once
+    
+    revenue = np.asarray(films['opening_gross'] / films['opening_theaters'], dtype=float)
+    if isinstance(subsequence, pd.DataFrame):
+        subsequence = subsequence.reindex(index=films.index, columns=films.index)
+        subsequence = sparse.csc_matrix(subsequence.fillna(0).values.astype(float))
+    else:
+        subsequence = sparse.csc_matrix(subsequence)
+    positions = films.index.get_indexer(features.index)
+    if (positions < 0).any():
+        raise KeyError('Error: features rows missing from films: %s' % list(features.index[positions < 0]))
+    weights = subsequence[:, positions]
+    totals = np.asarray(weights.sum(axis=0)).ravel()
+    contrib = weights.T.dot(revenue)
+    similar_past_revenue = np.where(totals > 0, contrib / np.where(totals > 0, totals, 1), 0)
+    
     expanded_features = features.copy(deep=True)
     expanded_features['similar_past_revenue'] = similar_past_revenue
     return expanded_features
 
 def train_and_test_data(train_films, test_films, output_dir, 
-                        add_const=True, verbose=False):
+                        add_const=True, n_jobs=1, cache=None, verbose=False):
     
     '''Generates test and train features and response based on the raw data.'''
     
@@ -284,6 +993,8 @@ def train_and_test_data(train_films, test_films, output_dir,
     (train_features, train_response) = generate_features(train_films, 
                                                          output_dir,
                                                          add_const=add_const,
+                                                         n_jobs=n_jobs,
+                                                         cache=cache,
                                                          verbose=verbose)
     
     if verbose:
@@ -291,10 +1002,76 @@ def train_and_test_data(train_films, test_films, output_dir,
     (test_features, test_response) = generate_features(test_films, 
                                                        output_dir,
                                                        add_const=add_const,
+                                                       n_jobs=n_jobs,
+                                                       cache=cache,
                                                        verbose=verbose)
     
     return (train_features, train_response, test_features, test_response)
 
+# features derived from Wikipedia revisions, left out of the "nowiki" sets
+# along with the edit-activity features
+wikipedia_features = ['avg_size', 'word_extfile', 'word_headings', 'word_imax']
+
+def feature_sets(films, train_index, test_index, output_dir, 
+                 metric=people_by_genres_jaccard, scores_file=None,
+                 n_jobs=1, cache=None, edit_horizons=(0, 7, 28), 
+                 edit_kinds=('edit_runs',), verbose=False):
+    
+    '''
+    Single-pass replacement for train_and_test_data() plus the similarity 
+    steps: features are generated once over the union of the train and test
+    films, subsequence scores are calculated once over all of films (cached 
+    in scores_file if given) and similar revenue is attached once. Returns 
+    (features, response, sets), where sets maps 'train', 'test', 
+    'train_nowiki' and 'test_nowiki' to (rows, columns) positional slices of
+    features; use select_features() to pull one out. features holds the 
+    train rows followed by the test rows, with the Wikipedia columns last, 
+    as one float array so that every set is a block of it. 
+    '''
+    
+    union = films.index[np.in1d(films.index, np.concatenate([train_index, test_index]))]
+    (base_features, response) = generate_features(films.ix[union], output_dir, 
+                                                  n_jobs=n_jobs, cache=cache,
+                                                  edit_horizons=edit_horizons,
+                                                  edit_kinds=edit_kinds,
+                                                  verbose=verbose)
+    subsequence = all_subsequence_scores(films, metric, scores_file=scores_file, verbose=verbose)
+    all_features = attach_similar_revenue(films, base_features, subsequence)
+    
+    wiki_columns = wikipedia_features + edit_activity_names(edit_horizons, edit_kinds)
+    nowiki_columns = [x for x in all_features.columns if x not in wiki_columns]
+    wiki_columns = [x for x in all_features.columns if x in wiki_columns]
+    rows = np.concatenate([train_index, test_index])
+    all_features = all_features.ix[rows, nowiki_columns + wiki_columns].astype(float)
+    response = response.ix[rows]
+    
+    (n_train, n_nowiki) = (len(train_index), len(nowiki_columns))
+    sets = { 'train': (slice(0, n_train), slice(None)),
+             'test': (slice(n_train, None), slice(None)),
+             'train_nowiki': (slice(0, n_train), slice(0, n_nowiki)),
+             'test_nowiki': (slice(n_train, None), slice(0, n_nowiki)) }
+    return (all_features, response, sets)
+
+def all_subsequence_scores(films, metric, scores_file=None, verbose=False):
+    '''
+    Subsequence scores over all of films by the fastest available route: 
+    cached in scores_file if given, else the sparse engine if metric has one.
+    '''
+    if scores_file is not None:
+        return cached_subsequence_scores(films, metric, scores_file, verbose=verbose)
+    elif metric in sparse_metrics:
+        return sparse_subsequence_scores(films, metric, verbose=verbose)
+    else:
+        return subsequence_scores(films, metric, verbose=verbose)
+
+def select_features(features, response, selection):
+    '''
+    Returns the (features, response) rows and columns in selection, as views
+    of features and response rather than copies. 
+    '''
+    (rows, columns) = selection
+    return (features.iloc[rows, columns], response.iloc[rows])
+
 ### Prediction generation
 
 def prediction_result(films, model, features, response, transform=None):
@@ -316,4 +1093,203 @@ def r2_result(result):
     '''
     total_var = sum((result['actual'] - result['actual'].mean())**2)
     pred_var = sum((result['actual'] - result['prediction'])**2)
-    return 1 - pred_var/total_var
\ No newline at end of file
+    return 1 - pred_var/total_var
+
+### Saved models
+
+# Bump model_version whenever the saved model format changes. 
+model_version = 1
+
+def save_model(filename, model, columns, metric=people_by_genres_jaccard,
+               edit_horizons=(0, 7, 28), edit_kinds=('edit_runs',)):
+    '''
+    Saves a fitted model to filename (with joblib) along with what scoring 
+    new films with it takes: the feature columns it was fit on, the metric 
+    and edit-activity settings those features were generated with, and the 
+    feature_version of the code that generated them. 
+    '''
+    joblib.dump({ 'model_version': model_version,
+                  'feature_version': feature_version,
+                  'model': model,
+                  'columns': list(columns),
+                  'metric': metric.__name__,
+                  'edit_horizons': tuple(edit_horizons),
+                  'edit_kinds': tuple(edit_kinds) }, filename)
+
+def load_model(filename):
+    '''
+    Loads a model saved by save_model(), checking that the features this code
+    generates are the ones it was fit on. 
+    '''
+    saved = joblib.load(filename)
+    if saved.get('model_version') != model_version:
+        raise Exception('Error: %s has model version %s, expected %s' % 
+                        (filename, saved.get('model_version'), model_version))
+    if saved['feature_version'] != feature_version:
+        raise Exception('Error: %s was fit on feature version %s, but features are now version %s; refit it' % 
+                        (filename, saved['feature_version'], feature_version))
+    return saved
+
+def saved_metric(saved):
+    '''Returns the similarity metric a model loaded by load_model() was fit with.'''
+    return globals()[saved['metric']]
+
+def score_films(saved, films, index, output_dir, subsequence=None, scores_file=None, 
+                cache=None, verbose=False):
+    '''
+    Predicts with a model loaded by load_model() for the films in films with
+    index labels in index; the rest of films only serve as antecedents for 
+    similar_past_revenue. subsequence holds the scores to use, as returned 
+    by subsequence_score_columns() for saved_metric(saved) and index (pass 
+    the same ones to every model scoring these films); if None, they are 
+    worked out here, reading stored scores from scores_file if given. With 
+    a warm cache (a FeatureCache) as well, nothing needs recomputing for 
+    films seen before. Returns a dataframe as returned by 
+    prediction_result(). 
+    '''
+    (base_features, response) = generate_features(films.ix[index], output_dir, cache=cache,
+                                                  edit_horizons=saved['edit_horizons'],
+                                                  edit_kinds=saved['edit_kinds'],
+                                                  verbose=verbose)
+    if subsequence is None:
+        subsequence = subsequence_score_columns(films, saved_metric(saved), index, 
+                                                filename=scores_file)
+    features = attach_similar_revenue(films, base_features, subsequence)
+    return prediction_result(films.ix[index], saved['model'], features[saved['columns']], response)
+
+### Live features - the revision-based features of upcoming films, kept up to
+### date as their articles are edited without rereading any old revisions
+
+class LiveFilmFeatures(object):
+    
+    '''
+    Running state of the revision-based features film_features() calculates
+    for one film: edit-activity counters per window (with the users seen in
+    each, for editors), the id, user and size of the newest revision, the 
+    lowercased wikitext and text feature counts of the newest one with 
+    content, and running sums of sizes and text feature counts. update() 
+    folds in revisions newer than all those seen so far in O(new revisions);
+    values() then returns exactly what film_features() would for all of 
+    them. settings identifies what the state was built for, to tell when it
+    has to start over. 
+    '''
+    
+    def __init__(self, film, edit_horizons=(0, 7, 28), edit_kinds=('edit_runs',), 
+                 settings=None):
+        self.opening_date = film['opening_date']
+        self.edit_horizons = tuple(edit_horizons)
+        self.edit_kinds = tuple(edit_kinds)
+        self.settings = settings
+        windows = len(self.edit_horizons) - 1
+        self.totals = dict((kind, [0] * windows) for kind in edit_activity_kinds)
+        self.editors = [set() for k in range(windows)]
+        self.revisions = 0
+        self.last_revid = None
+        self.last_user = None
+        self.last_size = None
+        self.run_window = None    # window of the newest edit of the latest run
+        self.last_text = None
+        self.last_counts = None
+        self.size_sum = 0
+        self.text_sums = [0] * len(text_features)
+    
+    def update(self, revisions):
+        '''Folds in revisions (API dicts, newest first), all newer than any seen.'''
+        revisions = revisions[::-1]
+        windows = len(self.edit_horizons) - 1
+        days = (self.opening_date.toordinal() - 
+                (parse_timestamps([rev['timestamp'] for rev in revisions]) // 86400 + epoch_ordinal))
+        counts = text_feature_counts([rev.get('*') for rev in revisions], 
+                                     self.last_text, self.last_counts)
+        for (rev, d, rev_counts) in zip(revisions, days, counts):
+            window = bisect.bisect_left(self.edit_horizons[1:], d)
+            user = rev.get('user')
+            size = rev.get('size', 0)
+            
+            # an edit run counts in the window of its newest edit, so an edit
+            # by the same user as the last one moves the run along
+            if self.revisions > 0 and user == self.last_user and self.run_window < windows:
+                self.totals['edit_runs'][self.run_window] -= 1
+            if window < windows:
+                self.totals['edit_runs'][window] += 1
+                if user is not None:
+                    self.editors[window].add(user)
+                if self.revisions > 0:
+                    self.totals['bytes_added'][window] += max(size - self.last_size, 0)
+                self.totals['minor_edits' if 'minor' in rev else 'major_edits'][window] += 1
+            
+            self.revisions += 1
+            self.last_revid = rev['revid']
+            self.last_user = user
+            self.last_size = size
+            self.run_window = window
+            self.size_sum += size
+            for k in range(len(text_features)):
+                self.text_sums[k] += rev_counts[k]
+            if '*' in rev:
+                self.last_text = rev['*'].lower()
+                self.last_counts = rev_counts
+    
+    def values(self):
+        '''Returns the revision-based features, as film_features() would.'''
+        self.totals['editors'] = [len(users) for users in self.editors]
+        values = {}
+        for kind in self.edit_kinds:
+            for k in range(len(self.edit_horizons) - 1):
+                name = '%s_%d_%d' % (kind, self.edit_horizons[k], self.edit_horizons[k+1])
+                values[name] = self.totals[kind][k]
+        if self.revisions > 0:
+            for (k, (name, pattern, width)) in enumerate(text_features):
+                values[name] = self.text_sums[k] / float(self.revisions)
+            values['avg_size'] = self.size_sum / float(self.revisions)
+        else:
+            values['avg_size'] = np.nan
+        return values
+
+def live_features(films, state_dir, horizon_start=0, horizon_end=28, 
+                  edit_horizons=(0, 7, 28), edit_kinds=('edit_runs',), 
+                  http_max_attempts=3, requests_per_second=None, 
+                  api_url=wikipedia_api_url, verbose=False):
+    
+    '''
+    Brings the LiveFilmFeatures of each film in films, kept in state_dir, up 
+    to date with the Wikipedia revisions made since the last call (fetching
+    only those), and returns (features, response) as generate_features() 
+    would with the revisions scraped by film_revision_scrape() between 
+    horizon_start and horizon_end. A film's state is saved after every batch
+    of revisions, and starts over if its opening date or the settings 
+    change. Content is fetched for every new revision. 
+    '''
+    
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    rate_limiter = RateLimiter(requests_per_second)
+    results = []
+    for film_i in films.index:
+        film = films.ix[film_i]
+        if film['wiki_title'] is None:
+            raise Exception('Error: no wiki_title found for film %s, index %i' % (film['title'], film_i))
+        settings = (film['wiki_title'], film['opening_date'], horizon_start, horizon_end,
+                    tuple(edit_horizons), tuple(edit_kinds), feature_version)
+        filename = os.path.join(state_dir, '%s.live' % revision_key(film['wiki_title']))
+        state = joblib.load(filename) if os.path.isfile(filename) else None
+        if state is None or state.settings != settings:
+            state = LiveFilmFeatures(film, edit_horizons, edit_kinds, settings)
+        
+        new_revisions = 0
+        for revisions in film_revision_updates(film, state.last_revid, horizon_start, horizon_end,
+                                               http_max_attempts=http_max_attempts,
+                                               rate_limiter=rate_limiter, api_url=api_url):
+            state.update(revisions)
+            new_revisions += len(revisions)
+            joblib.dump(state, filename + '.tmp')
+            os.rename(filename + '.tmp', filename)
+        if verbose:
+            print('(%d) %s / %d new revisions, %d in all' % 
+                  (film_i, film['wiki_title'], new_revisions, state.revisions))
+        
+        values = film_field_features(film)
+        values.update(state.values())
+        results.append(values)
+    
+    return features_frame(films, results, edit_horizons, edit_kinds)
@@ -1,7 +1,8 @@
-from retrieval.wikipedia import load_wikipedia_revisions
+from joblib import Parallel, delayed
+from retrieval.wikipedia import load_wikipedia_revision_view
 from sklearn import ensemble
-from sklearn.cross_validation import cross_val_score
-from sklearn.metrics import mean_squared_error
+from sklearn.cross_validation import check_cv
+from sklearn.metrics import mean_squared_error, r2_score
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
@@ -20,9 +21,8 @@ def wikipedia_revision_pattern(films, revision_dir, output, verbose=False,
         film = films.ix[i]
         if verbose:
             print(film['title'])
-        revisions = load_wikipedia_revisions(film, revision_dir)
-        for rev in revisions:
-            days_back.append((film['opening_date'] - rev['timestamp'].date()).days)
+        revisions = load_wikipedia_revision_view(film, revision_dir)
+        days_back.extend(revisions.days_before(film['opening_date']))
     plt.figure(figsize=(5,2.5))
     ax = plt.axes()
     ax.hist(days_back, bins=day_limit)
@@ -38,28 +38,67 @@ def gradient_boost_parameter_grid(train_features, train_response,
                                   test_features, test_response, 
                                   max_depths=pd.Series([2,3,5,7,10]),
                                   n_estimators=np.arange(10,301,10),
-                                  cv_folds=5,
+                                  cv_folds=5, n_jobs=1,
                                   verbose=False, **kwargs):
     
+    '''
+    Cross-validated train R^2 and test R^2 of gradient boosting models for 
+    each combination of max_depths and n_estimators, as two dataframes with 
+    a column per depth and a row per number of estimators. A model with n 
+    estimators is the first n stages of a larger one, so only one model is 
+    fit per depth and fold (plus one on all of the training data), with the
+    R^2 at each n read off its staged predictions; these fits are spread 
+    over n_jobs processes. 
+    '''
+    
+    X = np.asarray(train_features)
+    y = np.asarray(train_response)
+    folds = list(check_cv(cv_folds, X, y, classifier=False))
+    
+    tasks = []
+    for max_depth in max_depths:
+        for (k, (train, test)) in enumerate(folds):
+            tasks.append((max_depth, k, X[train], y[train], X[test], y[test], r2_score))
+        tasks.append((max_depth, None, train_features, train_response, test_features, test_response, 
+                      _test_r2))
+    if verbose:
+        print('Fitting %d models (%d depths, %d folds + test)' % (len(tasks), len(max_depths), len(folds)))
+    r2s = Parallel(n_jobs=n_jobs)(delayed(_staged_r2)(fit_features, fit_response, 
+                                                       score_features, score_response, 
+                                                       score, max_depth, n_estimators, kwargs)
+                                  for (max_depth, k, fit_features, fit_response, 
+                                       score_features, score_response, score) in tasks)
+    
     train_r2s = {}
     test_r2s = {}
-    
+    for (task, r2) in zip(tasks, r2s):
+        (max_depth, k) = task[:2]
+        if k is None:
+            test_r2s[max_depth] = dict(zip(n_estimators, r2))
+        else:
+            train_r2s.setdefault(max_depth, []).append(r2)
     for max_depth in max_depths:
-        train_r2s[max_depth] = {}
-        test_r2s[max_depth] = {}
-        for n in n_estimators:
-            if verbose:
-                print('Max depth = %d, estimators = %d' % (max_depth, n))
-            model = ensemble.GradientBoostingRegressor(n_estimators=n, max_depth=max_depth, **kwargs)
-            model.fit(train_features, train_response)
-            train_r2 = cross_val_score(model, train_features, train_response, cv=cv_folds).mean()
-            test_r2 = 1 - sum((test_response - model.predict(test_features))**2) / \
-                      float(sum((test_response - test_response.mean())**2))
-            train_r2s[max_depth][n] = train_r2
-            test_r2s[max_depth][n] = test_r2
+        train_r2s[max_depth] = dict(zip(n_estimators, np.mean(train_r2s[max_depth], axis=0)))
     
     return (pd.DataFrame(train_r2s), pd.DataFrame(test_r2s))
 
+def _test_r2(response, prediction):
+    return 1 - sum((response - prediction)**2) / \
+           float(sum((response - response.mean())**2))
+
+def _staged_r2(fit_features, fit_response, score_features, score_response, 
+               score, max_depth, n_estimators, kwargs):
+    '''score() on the score data of the first n stages of one model, for each n.'''
+    model = ensemble.GradientBoostingRegressor(n_estimators=max(n_estimators), 
+                                               max_depth=max_depth, **kwargs)
+    model.fit(fit_features, fit_response)
+    wanted = set(n_estimators)
+    r2 = {}
+    for (n, prediction) in enumerate(model.staged_predict(score_features), 1):
+        if n in wanted:
+            r2[n] = score(score_response, prediction)
+    return [r2[n] for n in n_estimators]
+
 def gradient_boost_parameter_graph(grid, output):
     
     plt.figure(figsize=(4,3.5))
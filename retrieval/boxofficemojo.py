@@ -1,15 +1,23 @@
-from bs4 import BeautifulSoup
-from utilities import http_query
+from bs4 import BeautifulSoup, SoupStrainer
+from utilities import http_get, http_get_many
 import datetime
 import numpy as np
 import pandas as pd
 import re
 import yaml
 
-def domestic_gross(years, config_file=None, http_max_attempts=3, verbose=False):
+# same choice BeautifulSoup makes by default, but stated up front; lxml is
+# much the faster of the two
+try:
+    import lxml
+    html_parser = 'lxml'
+except ImportError:
+    html_parser = 'html.parser'
+
+def domestic_gross(years, config_file=None, http_max_attempts=3, n_threads=8, verbose=False):
     '''
     Given a year or a list of years, returns a list of dictionaries containing 
-    film data for those years. 
+    film data for those years. Pages are fetched n_threads at a time. 
     '''
     if verbose:
         print('Processing Box Office Mojo annual gross lists...')
@@ -21,18 +29,33 @@ def domestic_gross(years, config_file=None, http_max_attempts=3, verbose=False):
     else:
         config = {}
     
-    films = []
+    # Pages are fetched n_threads at a time in a few waves: the first page of
+    # each year (which links to the others), the rest of the pages, and then
+    # the daily pages of the films that need them. 
     url_query = r'http://www.boxofficemojo.com/yearly/chart/'
-    for year in years:
-        url = r'%s?page=1&view=releasedate&view2=domestic&yr=%d&p=.htm' % (url_query, year)
-        soup = BeautifulSoup(http_query(url, http_max_attempts=http_max_attempts))
+    first_urls = [r'%s?page=1&view=releasedate&view2=domestic&yr=%d&p=.htm' % (url_query, year)
+                  for year in years]
+    chart_pages = dict(zip(first_urls, http_get_many(first_urls, http_max_attempts=http_max_attempts,
+                                                     n_threads=n_threads)))
+    page_urls = []
+    for (year, url) in zip(years, first_urls):
+        soup = BeautifulSoup(chart_pages[url], html_parser, parse_only=SoupStrainer('center'))
         first_page_link = soup.find('center')
         page_count = len(first_page_link.find_all('a')) + 1
-        for i in range(1, page_count+1):
-            if verbose:
-                print('BOM: %d page %d' % (year, i))
+        page_urls.append((year, 1, url))
+        for i in range(2, page_count+1):
             url = r'%s?page=%d&view=releasedate&view2=domestic&yr=%d&p=.htm' % (url_query, i, year)
-            films.extend(parse_domestic_gross_page(url, year, http_max_attempts=http_max_attempts))
+            page_urls.append((year, i, url))
+    urls = [url for (year, i, url) in page_urls if i > 1]
+    chart_pages.update(zip(urls, http_get_many(urls, http_max_attempts=http_max_attempts,
+                                               n_threads=n_threads)))
+    
+    rows = []
+    for (year, i, url) in page_urls:
+        if verbose:
+            print('BOM: %d page %d' % (year, i))
+        rows.extend(parse_domestic_gross_rows(chart_pages[url], year))
+    films = attach_opening_gross(rows, http_max_attempts=http_max_attempts, n_threads=n_threads)
     
     films = pd.DataFrame(films)
     if 'min_opening_theaters' in config:
@@ -46,7 +69,7 @@ def domestic_gross(years, config_file=None, http_max_attempts=3, verbose=False):
     
     return films
 
-def parse_domestic_gross_page(url, year=None, http_max_attempts=3):
+def parse_domestic_gross_page(url, year=None, http_max_attempts=3, n_threads=8):
     '''
     Parses one of Box Office Mojo's domestic gross by year lists and returns a
     pandas dataframe containing film data. 
@@ -58,7 +81,19 @@ def parse_domestic_gross_page(url, year=None, http_max_attempts=3):
         except:
             raise Exception('Unable to parse year from url %s' % url)
     
-    soup = BeautifulSoup(http_query(url, http_max_attempts=http_max_attempts))
+    rows = parse_domestic_gross_rows(http_get(url, http_max_attempts=http_max_attempts), year)
+    return attach_opening_gross(rows, http_max_attempts=http_max_attempts, n_threads=n_threads)
+
+def parse_domestic_gross_rows(html, year):
+    '''
+    Parses the film table out of the html of one of Box Office Mojo's 
+    domestic gross by year lists. Returns a list of film data dictionaries 
+    whose opening_gross is the weekend gross; for non-Friday openings, 
+    daily_url is the page to get the 3-day opening gross from instead (see 
+    attach_opening_gross). 
+    '''
+    
+    soup = BeautifulSoup(html, html_parser, parse_only=SoupStrainer('table'))
     films = []
     table = soup.find('td', text='Rank').parent.parent
     rows = table.find_all('tr')
@@ -79,29 +114,14 @@ def parse_domestic_gross_page(url, year=None, http_max_attempts=3):
             except: total_theaters = None
             try: opening_theaters = int(re.sub('\D', '', cells[6].get_text()))
             except: opening_theaters = None
+            try: opening_gross = int(re.sub('\D', '', cells[5].get_text()))
+            except: opening_gross = None
             
             if opening_date is not None and opening_date.weekday() != 4:
                 # for non-Friday openings, get the 3-day opening gross manually if it's available
                 daily_url = r'http://www.boxofficemojo.com%s&page=daily' % cells[1].find('a')['href']
-                daily_soup = BeautifulSoup(http_query(daily_url, http_max_attempts=http_max_attempts))
-                opening_gross = 0
-                for day in (opening_date, 
-                            opening_date + datetime.timedelta(days=1), 
-                            opening_date + datetime.timedelta(days=2)):
-                    href_re = re.compile(r'\/daily\/chart\/\?sortdate=%s' % day.strftime('%Y-%m-%d'))
-                    try:
-                        revs = daily_soup.find('a', href=href_re).parent.find('font', color=r'#000080').get_text()
-                        revs = int(re.sub('\D', '', revs))
-                    except AttributeError:
-                        try: opening_gross = int(re.sub('\D', '', cells[5].get_text()))
-                        except: opening_gross = None
-                        break
-                    opening_gross += revs
-                
             else:
-                try: opening_gross = int(re.sub('\D', '', cells[5].get_text()))
-                except: opening_gross = None
-                
+                daily_url = None
                 
             films.append({ 'title': title, 
                            'year': year, 
@@ -109,6 +129,51 @@ def parse_domestic_gross_page(url, year=None, http_max_attempts=3):
                            'total_gross': total_gross, 
                            'total_theaters': total_theaters, 
                            'opening_gross': opening_gross, 
-                           'opening_theaters': opening_theaters
+                           'opening_theaters': opening_theaters,
+                           'daily_url': daily_url
                           })
-    return films
\ No newline at end of file
+    return films
+
+def attach_opening_gross(films, http_max_attempts=3, n_threads=8):
+    '''
+    Given film data from parse_domestic_gross_rows(), fetches the daily pages
+    (n_threads at a time) and replaces opening_gross with the 3-day opening 
+    gross where one is available. Returns the film data without daily_url. 
+    '''
+    
+    daily_urls = []
+    for film in films:
+        if film['daily_url'] is not None and film['daily_url'] not in daily_urls:
+            daily_urls.append(film['daily_url'])
+    daily_pages = dict(zip(daily_urls, http_get_many(daily_urls, http_max_attempts=http_max_attempts,
+                                                     n_threads=n_threads)))
+    
+    result = []
+    for film in films:
+        film = dict(film)
+        daily_url = film.pop('daily_url')
+        if daily_url is not None:
+            film['opening_gross'] = daily_opening_gross(daily_pages[daily_url], film['opening_date'],
+                                                        film['opening_gross'])
+        result.append(film)
+    return result
+
+def daily_opening_gross(html, opening_date, weekend_gross=None):
+    '''
+    Sums the grosses for the three days from opening_date in the html of a 
+    Box Office Mojo daily page, or returns weekend_gross if any is missing. 
+    '''
+    
+    daily_soup = BeautifulSoup(html, html_parser, parse_only=SoupStrainer('table'))
+    opening_gross = 0
+    for day in (opening_date, 
+                opening_date + datetime.timedelta(days=1), 
+                opening_date + datetime.timedelta(days=2)):
+        href_re = re.compile(r'\/daily\/chart\/\?sortdate=%s' % day.strftime('%Y-%m-%d'))
+        try:
+            revs = daily_soup.find('a', href=href_re).parent.find('font', color=r'#000080').get_text()
+            revs = int(re.sub('\D', '', revs))
+        except AttributeError:
+            return weekend_gross
+        opening_gross += revs
+    return opening_gross
@@ -1,13 +1,25 @@
 import boxofficemojo
 import rottentomatoes
 import wikipedia
+from utilities import Journal, configure_http_client
 import datetime
+import os
+import os.path
 import pandas as pd
+import simplejson as json
+import threading
+
+# Stages of retrieve_all_data, in the order they run. Each one adds to the
+# films found by the ones before it. 
+stages = ['boxofficemojo', 'rottentomatoes', 'wikipedia_titles', 'wikipedia_revisions']
 
 def read_film_csv(film_csv, encoding='utf-8'):
     '''Read a saved film csv file (converts certain columns)'''
     films = pd.read_csv(film_csv, encoding=encoding)
-    films['opening_date'] = [datetime.datetime.strptime(x, '%Y-%m-%d').date() for x in films['opening_date']]
+    films['opening_date'] = [datetime.datetime.strptime(x, '%Y-%m-%d').date() if isinstance(x, basestring) else None
+                             for x in films['opening_date']]
+    if 'wiki_title' in films:
+        films['wiki_title'] = [x if isinstance(x, basestring) else None for x in films['wiki_title']]
     return films
 
 def write_film_csv(films, film_csv, encoding='utf-8'):
@@ -15,6 +27,29 @@ def write_film_csv(films, film_csv, encoding='utf-8'):
     films.to_csv(film_csv, index=False, encoding=encoding)
     return films
 
+class Progress(object):
+    
+    '''
+    Per-stage progress counters, rewritten to filename (as JSON) whenever 
+    one of them changes so that a long run can be watched from outside. 
+    '''
+    
+    def __init__(self, filename):
+        self.filename = filename
+        self.counts = {}
+        self.lock = threading.Lock()
+        if os.path.isfile(filename):
+            self.counts = json.loads(open(filename, 'r').read())
+    
+    def callback(self, stage):
+        '''Returns a function of (done, total) that updates stage's counter.'''
+        def update(done, total):
+            with self.lock:
+                self.counts[stage] = { 'done': done, 'total': total }
+                with open(self.filename + '.tmp', 'w') as f:
+                    f.write(json.dumps(self.counts, sort_keys=True, indent=2))
+                os.rename(self.filename + '.tmp', self.filename)
+        return update
 
 def retrieve_all_data(years, 
                       output_csv,
@@ -25,37 +60,168 @@ def retrieve_all_data(years,
                       boxofficemojo_config_file='config/boxofficemojo.yaml',
                       rottentomatoes_config_file='config/rottentomatoes.yaml',
                       wikipedia_config_file='config/wikipedia.yaml',
+                      wikipedia_threads=1,
+                      wikipedia_content_sample=None,
+                      rottentomatoes_threads=1,
+                      rottentomatoes_requests_per_second=None,
+                      rottentomatoes_requests_per_day=None,
+                      rottentomatoes_cache_dir=None,
+                      checkpoint_dir=None,
+                      run_stages=None,
+                      rerun_stages=None,
+                      http_cache_dir=None,
                       verbose=True):
     
     '''
     Runs all the retrieval-related functions at once - after running this you
     should have a local cache of Wikipedia revisions and also an output csv
     file with film data. 
+    
+    If checkpoint_dir is given, each year's results are saved there after 
+    every stage (as <stage>_<year>.csv), and the Rotten Tomatoes and 
+    Wikipedia title stages also journal each film as it is done, so that a 
+    rerun after a failure picks up where the last one stopped rather than 
+    starting over. A stage's checkpoint is only saved once every film is in
+    its journal, so films whose lookups failed are tried again on the next 
+    run (the films already journaled are not). Running a stage again 
+    discards the checkpoints of the stages after it, which then run again 
+    too. Per-stage progress counters are kept in progress.json in the same 
+    directory. run_stages restricts which stages (see stages) are run; 
+    stages left out are only loaded from their checkpoints, and years 
+    missing one stop there. rerun_stages lists stages to run again even 
+    where they have a checkpoint (through their journals, if any: delete 
+    a journal to redo its films as well). output_csv gets the films of 
+    every year that made it through wikipedia_titles. 
+    
+    If http_cache_dir is given, HTTP responses other than revision content
+    and API errors are cached there (see utilities.HttpClient), and a rerun
+    replays them instead of refetching; delete the directory to refetch. 
+    The rottentomatoes_ arguments are passed on to 
+    rottentomatoes.attach_rt_data(), and wikipedia_content_sample to 
+    wikipedia.film_revision_scrape() (as content_sample). 
     '''
-
-    films = boxofficemojo.domestic_gross(years=years,
-                                         config_file=boxofficemojo_config_file,
-                                         http_max_attempts=http_max_attempts,
-                                         verbose=verbose)
     
-    films = rottentomatoes.attach_rt_data(films=films,
-                                          config_file=rottentomatoes_config_file,
-                                          http_max_attempts=http_max_attempts,
-                                          verbose=verbose)
+    if http_cache_dir is not None:
+        configure_http_client(cache_dir=http_cache_dir)
     
-    films = wikipedia.attach_wikipedia_titles(films=films,
-                                              config_file=wikipedia_config_file,
-                                              http_max_attempts=http_max_attempts,
-                                              verbose=verbose)
+    if not hasattr(years, '__iter__'):
+        years = [years]
+    if run_stages is None:
+        run_stages = stages
+    if rerun_stages is None:
+        rerun_stages = []
+    for stage in list(run_stages) + list(rerun_stages):
+        if stage not in stages:
+            raise Exception('Error: unknown stage %s' % stage)
+    for stage in rerun_stages:
+        if stage not in run_stages:
+            raise Exception('Error: rerun stage %s is not in run_stages' % stage)
+    if checkpoint_dir is None:
+        if len(run_stages) != len(stages):
+            raise Exception('Error: run_stages requires a checkpoint_dir')
+        years = [list(years)]
+        progress = None
+    else:
+        if not os.path.isdir(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        progress = Progress(os.path.join(checkpoint_dir, 'progress.json'))
     
+    def run_stage(stage, films, year):
+        '''Returns (films, whether every film made it into the journal).'''
+        journal = None
+        if checkpoint_dir is not None:
+            callback = progress.callback('%s_%s' % (stage, year))
+            if stage in ('rottentomatoes', 'wikipedia_titles'):
+                journal = Journal(os.path.join(checkpoint_dir, '%s_%s.journal' % (stage, year)))
+        else:
+            callback = None
+        try:
+            if stage == 'boxofficemojo':
+                films = boxofficemojo.domestic_gross(years=year,
+                                                     config_file=boxofficemojo_config_file,
+                                                     http_max_attempts=http_max_attempts,
+                                                     verbose=verbose)
+                if callback is not None:
+                    callback(len(films.index), len(films.index))
+            elif stage == 'rottentomatoes':
+                films = rottentomatoes.attach_rt_data(films=films,
+                                                      config_file=rottentomatoes_config_file,
+                                                      http_max_attempts=http_max_attempts,
+                                                      cache_dir=rottentomatoes_cache_dir,
+                                                      n_threads=rottentomatoes_threads,
+                                                      requests_per_second=rottentomatoes_requests_per_second,
+                                                      requests_per_day=rottentomatoes_requests_per_day,
+                                                      journal=journal, progress=callback,
+                                                      verbose=verbose)
+            elif stage == 'wikipedia_titles':
+                films = wikipedia.attach_wikipedia_titles(films=films,
+                                                          config_file=wikipedia_config_file,
+                                                          http_max_attempts=http_max_attempts,
+                                                          journal=journal, progress=callback,
+                                                          verbose=verbose)
+            complete = True
+            if stage == 'rottentomatoes' and journal is not None:
+                # failed lookups are left out of the journal
+                complete = all(('%s (%d)' % (film['title'], film['year'])) in journal
+                               for (_, film) in films.iterrows())
+        finally:
+            if journal is not None:
+                journal.close()
+        return (films, complete)
+    
+    all_films = []
+    for year in years:
+        films = None
+        for (k, stage) in enumerate(stages[:-1]):
+            if checkpoint_dir is not None:
+                checkpoint = os.path.join(checkpoint_dir, '%s_%s.csv' % (stage, year))
+                if os.path.isfile(checkpoint) and stage not in rerun_stages:
+                    if verbose:
+                        print('Loading %s checkpoint for %s' % (stage, year))
+                    films = read_film_csv(checkpoint)
+                    continue
+            if stage not in run_stages:
+                if verbose:
+                    print('W: No %s checkpoint for %s, skipping the rest of it' % (stage, year))
+                films = None
+                break
+            (films, complete) = run_stage(stage, films, year)
+            if checkpoint_dir is not None:
+                # the later stages' checkpoints were built on the old results
+                for later in stages[k + 1:-1]:
+                    later_checkpoint = os.path.join(checkpoint_dir, '%s_%s.csv' % (later, year))
+                    if os.path.isfile(later_checkpoint):
+                        os.remove(later_checkpoint)
+                if complete:
+                    write_film_csv(films, checkpoint)
+                else:
+                    if os.path.isfile(checkpoint):
+                        os.remove(checkpoint)
+                    if verbose:
+                        print('W: Some %s lookups for %s failed, not saving a checkpoint' % (stage, year))
+        if films is not None:
+            all_films.append(films)
+    
+    if not all_films:
+        return None
+    films = pd.concat(all_films, ignore_index=True)
     write_film_csv(films, output_csv)
     
-    if wikipedia_scrape_dir is not None:
+    if wikipedia_scrape_dir is not None and 'wikipedia_revisions' in run_stages:
+        if progress is not None:
+            callback = progress.callback('wikipedia_revisions')
+        else:
+            callback = None
+        # already-scraped films are skipped, so the scrape directory doubles
+        # as this stage's per-film checkpoint
         wikipedia.film_revision_scrape(films=films,
                                        output_dir=wikipedia_scrape_dir,
                                        horizon_start=wikipedia_horizon_start,
                                        horizon_end=wikipedia_horizon_end,
                                        http_max_attempts=http_max_attempts,
+                                       n_threads=wikipedia_threads,
+                                       content_sample=wikipedia_content_sample,
+                                       progress=callback,
                                        verbose=verbose)
         
-    return films
\ No newline at end of file
+    return films
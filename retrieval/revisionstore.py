@@ -0,0 +1,524 @@
+import calendar
+import datetime
+import hashlib
+import joblib
+import numpy as np
+import os
+import os.path
+import re
+import simplejson as json
+import struct
+import zlib
+
+# A consolidated, columnar store for Wikipedia revisions. Instead of one pickle
+# of raw API dicts per film, every revision of every film is a row in a set of
+# flat binary column files, memory-mapped on load, plus one blob holding the
+# wikitext. Films are addressed by the same key as the revision pickles (the
+# md5 of the article title) and own one or more contiguous segments of rows.
+# Loading a film returns a FilmRevisions view over the columns, so features
+# that only need timestamps, users and sizes never touch the content.
+#
+# Content is delta-encoded: within each appended batch, every 
+# snapshot_interval-th revision with content is stored in full (zlib-
+# compressed, record b'S' + data) and the ones in between as the difference
+# from the previous one (b'D', then the lengths of the common prefix and 
+# suffix and the zlib-compressed middle). Version 1 stores hold raw content
+# and are still read. 
+
+store_subdir = 'store'
+store_version = 2
+snapshot_interval = 32
+
+columns = [('timestamp', '<i8'),       # seconds since the epoch, UTC
+           ('size', '<i8'),
+           ('user', '<i4'),            # index into the users list, -1 if hidden
+           ('revid', '<i8'),
+           ('minor', 'i1'),
+           ('content_offset', '<i8'),  # byte offset into the content blob, -1 if none
+           ('content_length', '<i8')]
+
+def revision_key(wiki_title):
+    '''Returns the key (file name stem) a film's revisions are stored under.'''
+    return hashlib.md5(wiki_title.encode('utf-8')).hexdigest()
+
+epoch_ordinal = datetime.date(1970, 1, 1).toordinal()
+
+def common_affixes(old, new):
+    '''Returns the lengths of the common prefix and (non-overlapping) suffix'''
+    (lo, hi) = (0, min(len(old), len(new)))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if old[:mid] == new[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    prefix = lo
+    (lo, hi) = (0, min(len(old), len(new)) - prefix)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if old[len(old)-mid:] == new[len(new)-mid:]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return (prefix, lo)
+
+def encode_contents(contents, interval=snapshot_interval):
+    '''
+    Delta-encodes a sequence of revision contents (utf-8 byte strings, or 
+    None) into a list of content records (None where there is no content). 
+    '''
+    records = []
+    previous = None
+    since_snapshot = 0
+    for content in contents:
+        if content is None:
+            records.append(None)
+            continue
+        if previous is None or since_snapshot >= interval:
+            records.append(b'S' + zlib.compress(content))
+            since_snapshot = 0
+        else:
+            (prefix, suffix) = common_affixes(previous, content)
+            records.append(b'D' + struct.pack('<ii', prefix, suffix) + 
+                           zlib.compress(content[prefix:len(content) - suffix]))
+        since_snapshot += 1
+        previous = content
+    return records
+
+def apply_delta(previous, record):
+    '''Reconstructs a content from the previous one and its b'D' record.'''
+    (prefix, suffix) = struct.unpack('<ii', record[1:9])
+    return previous[:prefix] + zlib.decompress(record[9:]) + previous[len(previous) - suffix:]
+
+def parse_timestamp(timestamp):
+    '''Converts a MediaWiki API timestamp to seconds since the epoch.'''
+    return calendar.timegm(datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ').timetuple())
+
+def parse_timestamps(timestamps):
+    
+    '''
+    Vectorized parse_timestamp(): converts a sequence of MediaWiki API 
+    timestamps (all in the fixed-width YYYY-MM-DDTHH:MM:SSZ format) to an 
+    int64 array of seconds since the epoch in one pass over their digits. 
+    '''
+    
+    digits = np.array(timestamps, dtype='S20').view(np.uint8).reshape(-1, 20).astype(np.int64) - ord('0')
+    def field(start, end):
+        value = np.zeros(len(digits), dtype=np.int64)
+        for k in range(start, end):
+            value = value * 10 + digits[:, k]
+        return value
+    (year, month, day) = (field(0, 4), field(5, 7), field(8, 10))
+    
+    # days since the epoch of a proleptic Gregorian date, with the year 
+    # starting in March so that leap days fall at the end
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * np.where(month > 2, month - 3, month + 9) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    days = era * 146097 + day_of_era - 719468
+    
+    return days * 86400 + field(11, 13) * 3600 + field(14, 16) * 60 + field(17, 19)
+
+class FilmRevisions(object):
+
+    '''
+    Lazy view of one film's revisions, in the order the API returned them
+    (newest first). Metadata are numpy arrays (timestamp, size, user, revid,
+    minor); content is only read from the blob when content() is called.
+    Iterating yields revision dicts like the ones load_wikipedia_revisions()
+    reads from pickles, but only with the fields kept here (see __iter__()).
+    With encoding 'delta', the blob holds content records
+    (see encode_contents()); the last content decoded is remembered, so 
+    reading the revisions in order applies one delta each, while reading 
+    any one revision applies at most snapshot_interval of them. 
+    content_sample is set if only a sample of the revisions was scraped 
+    with content (see wikipedia.film_revision_scrape()). 
+    '''
+
+    def __init__(self, arrays, users, blob=None, encoding='raw', content_sample=None):
+        self.timestamp = arrays['timestamp']
+        self.size = arrays['size']
+        self.user = arrays['user']
+        self.revid = arrays['revid']
+        self.minor = arrays['minor']
+        self.content_offset = arrays['content_offset']
+        self.content_length = arrays['content_length']
+        self.users = users
+        self.blob = blob
+        self.encoding = encoding
+        self.content_sample = content_sample
+        self.last_content = (None, None)
+
+    @classmethod
+    def from_dicts(cls, revisions, encoding='raw'):
+        '''Builds an in-memory view from a list of raw API revision dicts.'''
+        users = []
+        user_ids = {}
+        contents = []
+        offset = 0
+        arrays = dict((name, np.zeros(len(revisions), dtype=dtype)) for (name, dtype) in columns)
+        arrays['timestamp'][:] = parse_timestamps([rev['timestamp'] for rev in revisions])
+        for (j, rev) in enumerate(revisions):
+            arrays['size'][j] = rev.get('size', 0)
+            if 'user' in rev:
+                arrays['user'][j] = user_ids.setdefault(rev['user'], len(users))
+                if arrays['user'][j] == len(users):
+                    users.append(rev['user'])
+            else:
+                arrays['user'][j] = -1
+            arrays['revid'][j] = rev.get('revid', 0)
+            arrays['minor'][j] = 'minor' in rev
+            contents.append(rev['*'].encode('utf-8') if '*' in rev else None)
+        if encoding == 'delta':
+            contents = encode_contents(contents)
+        for (j, content) in enumerate(contents):
+            if content is not None:
+                arrays['content_offset'][j] = offset
+                arrays['content_length'][j] = len(content)
+                offset += len(content)
+            else:
+                arrays['content_offset'][j] = -1
+        if offset > 0:
+            blob = np.frombuffer(b''.join(x for x in contents if x is not None), dtype=np.uint8)
+        else:
+            blob = np.zeros(0, dtype=np.uint8)
+        return cls(arrays, users, blob, encoding)
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def user_name(self, j):
+        '''Returns the name of the user who made revision j, or None if hidden.'''
+        if self.user[j] < 0:
+            return None
+        return self.users[self.user[j]]
+
+    def datetime(self, j):
+        '''Returns the timestamp of revision j as a (UTC) datetime.'''
+        return datetime.datetime.utcfromtimestamp(int(self.timestamp[j]))
+
+    def days_before(self, date):
+        '''
+        Returns an array of the number of days between each revision's (UTC)
+        date and date, the same as (date - timestamp.date()).days. 
+        '''
+        return date.toordinal() - (self.timestamp // 86400 + epoch_ordinal)
+
+    def has_content(self, j):
+        return self.content_offset[j] >= 0
+
+    def record(self, j):
+        '''Returns the stored bytes of revision j's content.'''
+        start = int(self.content_offset[j])
+        return self.blob[start:start + int(self.content_length[j])].tostring()
+
+    def content(self, j):
+        '''Returns the wikitext of revision j, or None if it was not stored.'''
+        if self.content_offset[j] < 0:
+            return None
+        if self.encoding == 'raw':
+            return self.record(j).decode('utf-8')
+        
+        # walk back to a snapshot (or the last content decoded), then forward
+        deltas = []
+        k = j
+        while True:
+            if self.last_content[0] == k:
+                content = self.last_content[1]
+                break
+            record = self.record(k)
+            if record[:1] == b'S':
+                content = zlib.decompress(record[1:])
+                break
+            deltas.append(record)
+            k -= 1
+            while self.content_offset[k] < 0:
+                k -= 1
+        for record in reversed(deltas):
+            content = apply_delta(content, record)
+        self.last_content = (j, content)
+        return content.decode('utf-8')
+
+    def __iter__(self):
+        '''
+        Yields a dict per revision with 'timestamp' (a UTC datetime), 'size',
+        'revid', 'user' (unless hidden), 'minor' (if set) and '*' (if it has
+        content). Every other field of the API's revision dicts, notably 
+        'comment', 'userid', 'parentid' and 'anon', is not stored and so is 
+        missing. 
+        '''
+        for j in range(len(self)):
+            rev = { 'timestamp': self.datetime(j),
+                    'size': int(self.size[j]),
+                    'revid': int(self.revid[j]) }
+            if self.user[j] >= 0:
+                rev['user'] = self.user_name(j)
+            if self.minor[j]:
+                rev['minor'] = ''
+            if self.has_content(j):
+                rev['*'] = self.content(j)
+            yield rev
+
+class RevisionStore(object):
+
+    '''
+    Columnar revision store in directory path. Open with mode 'r' to read
+    (columns are memory-mapped) or 'a' to append films. Rows are only
+    visible once flush() has recorded them in the index, so a crash while
+    appending loses at most the unflushed films.
+    '''
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.mode = mode
+        index_file = os.path.join(path, 'index.json')
+        if os.path.isfile(index_file):
+            self.index = json.loads(open(index_file, 'r').read())
+            if self.index['version'] not in (1, store_version):
+                raise Exception('Error: revision store %s has version %s, expected %s' %
+                                (path, self.index['version'], store_version))
+        elif mode == 'a':
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.index = { 'version': store_version, 'rows': 0, 'content_bytes': 0,
+                           'users': 0, 'films': {} }
+        else:
+            raise Exception('Error: no revision store found in %s' % path)
+        self.encoding = 'raw' if self.index['version'] == 1 else 'delta'
+
+        users_file = os.path.join(path, 'users.txt')
+        self.users = []
+        if self.index['users'] > 0:
+            with open(users_file, 'rb') as f:
+                for line in f:
+                    if len(self.users) == self.index['users']:
+                        break
+                    self.users.append(line.rstrip(b'\n').decode('utf-8'))
+
+        if mode == 'a':
+            # drop anything written after the last flush, then append
+            self.user_ids = dict((name, k) for (k, name) in enumerate(self.users))
+            self.files = {}
+            for (name, dtype) in columns:
+                self.files[name] = self._truncated(name + '.bin', self.index['rows'] * np.dtype(dtype).itemsize)
+            self.files['content'] = self._truncated('content.blob', self.index['content_bytes'])
+            user_bytes = sum(len(x.encode('utf-8')) + 1 for x in self.users)
+            self.files['users'] = self._truncated('users.txt', user_bytes)
+        else:
+            self._map()
+
+    def _truncated(self, filename, length):
+        filename = os.path.join(self.path, filename)
+        f = open(filename, 'ab')
+        f.truncate(length)
+        return f
+
+    def _map(self):
+        rows = self.index['rows']
+        self.arrays = {}
+        for (name, dtype) in columns:
+            if rows > 0:
+                self.arrays[name] = np.memmap(os.path.join(self.path, name + '.bin'),
+                                              dtype=dtype, mode='r', shape=(rows,))
+            else:
+                self.arrays[name] = np.zeros(0, dtype=dtype)
+        if self.index['content_bytes'] > 0:
+            self.blob = np.memmap(os.path.join(self.path, 'content.blob'), dtype=np.uint8,
+                                  mode='r', shape=(self.index['content_bytes'],))
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)
+
+    def __contains__(self, key):
+        return key in self.index['films']
+
+    def keys(self):
+        return self.index['films'].keys()
+
+    def film(self, key):
+        '''Returns a FilmRevisions view of the film stored under key.'''
+        if self.mode != 'r':
+            raise Exception('Error: revision store %s is not open for reading' % self.path)
+        if key not in self.index['films']:
+            raise Exception('Error: no revisions stored for %s' % key)
+        segments = self.index['films'][key]['segments']
+        arrays = {}
+        for (name, dtype) in columns:
+            if len(segments) == 1:
+                (start, count) = segments[0]
+                arrays[name] = self.arrays[name][start:start + count]
+            else:
+                arrays[name] = np.concatenate([self.arrays[name][start:start + count]
+                                               for (start, count) in segments] +
+                                              [np.zeros(0, dtype=dtype)])
+        return FilmRevisions(arrays, self.users, self.blob, self.encoding,
+                             self.index['films'][key].get('content_sample'))
+
+    def append(self, key, revisions, title=None):
+        '''
+        Appends a list of raw API revision dicts to the film stored under key
+        (creating it if necessary). Call flush() to make them visible.
+        '''
+
+        if self.mode != 'a':
+            raise Exception('Error: revision store %s is not open for appending' % self.path)
+        view = FilmRevisions.from_dicts(revisions, encoding=self.encoding)
+
+        # re-intern this batch's users against the store's list
+        user_map = np.zeros(len(view.users) + 1, dtype='<i4')
+        user_map[-1] = -1
+        for (k, name) in enumerate(view.users):
+            if name not in self.user_ids:
+                self.user_ids[name] = len(self.users)
+                self.users.append(name)
+                self.files['users'].write(name.encode('utf-8') + b'\n')
+            user_map[k] = self.user_ids[name]
+
+        arrays = { 'timestamp': view.timestamp, 'size': view.size,
+                   'user': user_map[view.user], 'revid': view.revid,
+                   'minor': view.minor, 'content_length': view.content_length,
+                   'content_offset': np.where(view.content_offset >= 0,
+                                              view.content_offset + self.index['content_bytes'], -1) }
+        for (name, dtype) in columns:
+            self.files[name].write(np.asarray(arrays[name], dtype=dtype).tostring())
+        self.files['content'].write(view.blob.tostring())
+
+        film = self.index['films'].setdefault(key, { 'segments': [], 'complete': False })
+        if title is not None:
+            film['title'] = title
+        start = self.index['rows']
+        if len(film['segments']) > 0 and sum(film['segments'][-1]) == start:
+            film['segments'][-1][1] += len(view)
+        elif len(view) > 0:
+            film['segments'].append([start, len(view)])
+        self.index['rows'] += len(view)
+        self.index['content_bytes'] += len(view.blob)
+        self.index['users'] = len(self.users)
+
+    def set_complete(self, key, complete=True):
+        '''Marks whether all of a film's revisions have been stored.'''
+        self.index['films'][key]['complete'] = complete
+
+    def is_complete(self, key):
+        return key in self.index['films'] and self.index['films'][key]['complete']
+
+    def set_cursor(self, key, cursor, sample_state=None):
+        '''
+        Records where to resume downloading a film's revisions from (an API
+        continuation value) and the content sampling state at that point 
+        (see wikipedia.sample_revisions()), or clears both if cursor is None.
+        '''
+        if cursor is None:
+            self.index['films'][key].pop('cursor', None)
+            self.index['films'][key].pop('sample_state', None)
+        else:
+            self.index['films'][key]['cursor'] = cursor
+            self.index['films'][key]['sample_state'] = sample_state
+
+    def set_content_sample(self, key, content_sample):
+        '''
+        Records which revisions of a film have content: None for all of 
+        them, otherwise the content_sample it was scraped with. 
+        '''
+        if content_sample is None:
+            self.index['films'][key].pop('content_sample', None)
+        else:
+            self.index['films'][key]['content_sample'] = content_sample
+
+    def cursor(self, key):
+        '''Returns the film's saved download cursor, or None.'''
+        return self.index['films'].get(key, {}).get('cursor')
+
+    def sample_state(self, key):
+        '''Returns the content sampling state saved with the cursor, or None.'''
+        return self.index['films'].get(key, {}).get('sample_state')
+
+    def remove(self, key):
+        '''Forgets a film (its rows stay in the column files, unreferenced).'''
+        self.index['films'].pop(key, None)
+
+    def flush(self):
+        '''Writes out appended data and the index that makes it visible.'''
+        for f in self.files.values():
+            f.flush()
+            os.fsync(f.fileno())
+        index_file = os.path.join(self.path, 'index.json')
+        with open(index_file + '.tmp', 'w') as f:
+            f.write(json.dumps(self.index))
+        os.rename(index_file + '.tmp', index_file)
+
+    def close(self):
+        if self.mode == 'a':
+            self.flush()
+            for f in self.files.values():
+                f.close()
+
+def has_revision_store(output_dir):
+    '''Whether output_dir contains a converted revision store.'''
+    return os.path.isfile(os.path.join(output_dir, store_subdir, 'index.json'))
+
+def convert_revision_pickles(revision_dir, store_dir=None, verbose=False):
+
+    '''
+    One-shot conversion of the per-film joblib pickles written by
+    film_revision_scrape() in revision_dir into a revision store (by default
+    in the store subdirectory of revision_dir). Films already in the store
+    are skipped, so an interrupted conversion can just be rerun. Use 
+    verify_revision_store() to check the result against the pickles. 
+    '''
+
+    if store_dir is None:
+        store_dir = os.path.join(revision_dir, store_subdir)
+    store = RevisionStore(store_dir, mode='a')
+    filenames = sorted(x for x in os.listdir(revision_dir)
+                       if re.match(r'^[0-9a-f]{32}\.revisions$', x))
+    for (k, filename) in enumerate(filenames):
+        key = filename[:-len('.revisions')]
+        if store.is_complete(key):
+            continue
+        if verbose:
+            print('(%d/%d) %s' % (k + 1, len(filenames), filename))
+        store.remove(key)
+        store.append(key, joblib.load(os.path.join(revision_dir, filename)))
+        store.set_complete(key)
+        store.flush()
+    store.close()
+    return store_dir
+
+def verify_revision_store(revision_dir, store_dir=None, verbose=False):
+
+    '''
+    Checks that every revision in the per-film pickles in revision_dir comes
+    back byte for byte from the revision store (by default in the store 
+    subdirectory of revision_dir), both reading each film in order and 
+    reading its revisions one at a time in reverse. Raises an exception at 
+    the first difference; returns the number of revisions checked. 
+    '''
+
+    if store_dir is None:
+        store_dir = os.path.join(revision_dir, store_subdir)
+    store = RevisionStore(store_dir, mode='r')
+    filenames = sorted(x for x in os.listdir(revision_dir)
+                       if re.match(r'^[0-9a-f]{32}\.revisions$', x))
+    checked = 0
+    for (k, filename) in enumerate(filenames):
+        key = filename[:-len('.revisions')]
+        if verbose:
+            print('(%d/%d) %s' % (k + 1, len(filenames), filename))
+        revisions = joblib.load(os.path.join(revision_dir, filename))
+        if not store.is_complete(key) or len(store.film(key)) != len(revisions):
+            raise Exception('Error: %s is missing or incomplete in %s' % (filename, store_dir))
+        expected = [rev['*'].encode('utf-8') if '*' in rev else None for rev in revisions]
+        view = store.film(key)
+        for j in range(len(view)):
+            content = view.content(j)
+            if (content.encode('utf-8') if content is not None else None) != expected[j]:
+                raise Exception('Error: revision %d of %s differs' % (j, filename))
+        view = store.film(key)
+        for j in reversed(range(len(view))):
+            content = view.content(j)
+            if (content.encode('utf-8') if content is not None else None) != expected[j]:
+                raise Exception('Error: revision %d of %s differs' % (j, filename))
+        checked += len(revisions)
+    return checked
@@ -1,12 +1,34 @@
-from utilities import http_query
+from utilities import Journal, QuotaExceeded, QuotaLimiter, forget_http_response, http_get
 import difflib
+import os
+import os.path
+import Queue
 import re
 import simplejson as json
+import threading
 import urllib
 import yaml
 
 def attach_rt_data(films, api_key=None, config_file=None, http_max_attempts=3,
-                   verbose=False):
+                   cache_dir=None, n_threads=1, requests_per_second=None, 
+                   requests_per_day=None, journal=None, progress=None, verbose=False):
+    
+    '''
+    Attaches Rotten Tomatoes data (rating, runtime, genres, ids, directors and
+    cast) to the dataframe films and returns it. If journal (a 
+    utilities.Journal) is given, each film's data is recorded in it as soon 
+    as it is retrieved, and films already recorded there are not queried 
+    again. progress, if given, is called with (films done, total films). 
+    A film whose lookup fails (after retries) gets a row of None like 
+    before, but is not journaled, so that a rerun tries it again. 
+    
+    Films are looked up by n_threads threads at once, with API calls spread
+    out to at most requests_per_second and capped at requests_per_day (the 
+    daily count is kept in cache_dir, if given, so it carries across runs; 
+    see utilities.QuotaLimiter). If cache_dir is given, search results (by 
+    title and year) and film data (by Rotten Tomatoes id) are also kept 
+    there, and films resolved in an earlier run cost no API calls. 
+    '''
     
     if config_file is not None:
         config = yaml.load(open(config_file, 'r').read())
@@ -18,103 +40,215 @@ def attach_rt_data(films, api_key=None, config_file=None, http_max_attempts=3,
     if config['api_key'] is None:
         raise Exception('Either api_key or a config_file with an API key must be specified')
     
-    all_rt_data = { 'mpaa_rating': [],
-                    'runtime': [],
-                    'genres': [],
-                    'imdb_id': [],
-                    'rt_id': [],
-                    'directors': [],
-                    'actors': [],
-                  }
-    
     if 'id_override' in config:
         id_override = config['id_override']
     else:
         id_override = {}
     
-    for i in films.index:
+    if cache_dir is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        cache = { 'search': Journal(os.path.join(cache_dir, 'search.journal')),
+                  'film_info': Journal(os.path.join(cache_dir, 'film_info.journal')) }
+        quota_file = os.path.join(cache_dir, 'quota.json')
+    else:
+        cache = None
+        quota_file = None
+    limiter = QuotaLimiter(per_second=requests_per_second, per_day=requests_per_day,
+                           state_file=quota_file)
+    
+    rows = [None] * len(films.index)
+    tasks = Queue.Queue()
+    for (k, i) in enumerate(films.index):
         film = films.ix[i]
-        (title, year) = (film['title'], film['year'])
-        title_year = '%s (%d)' % (title, year)
-        if title_year in id_override:
-            rt_id = id_override[title_year]
+        title_year = '%s (%d)' % (film['title'], film['year'])
+        if journal is not None and title_year in journal:
+            rows[k] = journal[title_year]
         else:
-            # Get the best search hit first, then query by id. Why not just use
-            # search data? Because genres are missing from search query data
-            # alone, sadly - you have to make a direct query for the film by id
-            # to get them. 
+            tasks.put((k, film))
+    
+    done = [len(films.index) - tasks.qsize()]
+    errors = []
+    lock = threading.Lock()
+    if progress is not None:
+        progress(done[0], len(films.index))
+    
+    def worker():
+        while not errors:
             try:
-                rt_search_data = film_search_best_hit(film['title'], film['year'], 
-                                                      api_key=config['api_key'], 
-                                                      http_max_attempts=http_max_attempts,
-                                                      verbose=verbose)
-                rt_id = rt_search_data['id']
-            except:
-                if verbose:
-                    print('RT: No film ID matched to %s (%s)' % (film['title'], film['year']))
-                rt_id = None
-        
-        if rt_id is not None:
+                (k, film) = tasks.get_nowait()
+            except Queue.Empty:
+                return
             try:
-                rt_data = film_info(rt_id, config['api_key'], http_max_attempts=http_max_attempts)
-            except:
-                rt_data = {}
-            # verbose mode gives a heads-up if the title wasn't a precise match        
-            if verbose and re.sub('\W', '', rt_data['title']).lower() != re.sub('\W', '', title).lower():
-                print('RT: Using %s for %s (%s)' % (rt_data['title'], title, year))
+                rows[k] = film_rt_data(film, config['api_key'], id_override=id_override,
+                                       http_max_attempts=http_max_attempts, cache=cache,
+                                       limiter=limiter, raise_errors=True, verbose=verbose)
+            except QuotaExceeded as e:
+                errors.append(e)
+                return
+            except Exception as e:
+                if verbose:
+                    print('RT: Lookup failed for %s (%s), will retry next run: %s' % 
+                          (film['title'], film['year'], e))
+                rows[k] = dict((col, None) for col in rt_columns)
+            except BaseException as e:
+                errors.append(e)
+                return
+            else:
+                if journal is not None:
+                    journal.put('%s (%d)' % (film['title'], film['year']), rows[k])
+            with lock:
+                done[0] += 1
+                if progress is not None:
+                    progress(done[0], len(films.index))
+    
+    try:
+        if n_threads == 1:
+            worker()
         else:
-            rt_data = {}
-        
-        try: all_rt_data['mpaa_rating'].append(rt_data['mpaa_rating'])
-        except: all_rt_data['mpaa_rating'].append(None)
-        try: all_rt_data['runtime'].append(int(rt_data['runtime']))
-        except: all_rt_data['runtime'].append(None)
-        try: all_rt_data['genres'].append(','.join(rt_data['genres']))
-        except: all_rt_data['genres'].append(None)
-        try: all_rt_data['rt_id'].append(rt_data['id'])
-        except: all_rt_data['rt_id'].append(None)
-        try: all_rt_data['imdb_id'].append(rt_data['alternate_ids']['imdb'])
-        except: all_rt_data['imdb_id'].append(None)
-        
-        try:
-            directors = []
-            for director in rt_data['abridged_directors']:
-                if 'name' in director:
-                    directors.append(director['name'])
-            all_rt_data['directors'].append(','.join(directors))
-        except:
-            all_rt_data['directors'].append(None)
-        try:
-            actors = []
-            for actor in rt_data['abridged_cast']:
-                if 'name' in actor:
-                    actors.append(actor['name'])
-            all_rt_data['actors'].append(','.join(actors))
-        except:
-            all_rt_data['actors'].append(None)
+            threads = [threading.Thread(target=worker) for _ in range(n_threads)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    finally:
+        if cache is not None:
+            for c in cache.values():
+                c.close()
+    if errors:
+        raise errors[0]
     
-    for col in all_rt_data:
-        films[col] = all_rt_data[col]
+    for col in rt_columns:
+        films[col] = [row[col] for row in rows]
     
     return films
 
-def film_info(id, api_key, http_max_attempts=3):
+rt_columns = ['mpaa_rating', 'runtime', 'genres', 'imdb_id', 'rt_id', 'directors', 'actors']
+
+def film_rt_data(film, api_key, id_override=None, http_max_attempts=3, cache=None, 
+                 limiter=None, raise_errors=False, verbose=False):
+    
+    '''
+    Looks up the Rotten Tomatoes data for one film (anything with 'title' and
+    'year') and returns it as a dict with keys rt_columns, None for whatever 
+    could not be found. cache, if given, is a dict of 'search' and 
+    'film_info' journals (see attach_rt_data) consulted before the API. 
+    Failed API calls (including error responses) are treated as finding 
+    nothing, unless raise_errors is True, in which case they raise. 
+    '''
+    
+    if id_override is None:
+        id_override = {}
+    (title, year) = (film['title'], film['year'])
+    title_year = '%s (%d)' % (title, year)
+    if title_year in id_override:
+        rt_id = id_override[title_year]
+    elif cache is not None and title_year in cache['search']:
+        rt_id = cache['search'][title_year]
+    else:
+        # Get the best search hit first, then query by id. Why not just use
+        # search data? Because genres are missing from search query data
+        # alone, sadly - you have to make a direct query for the film by id
+        # to get them. 
+        try:
+            rt_search_data = film_search_best_hit(title, year, api_key=api_key,
+                                                  http_max_attempts=http_max_attempts,
+                                                  limiter=limiter, verbose=verbose)
+            rt_id = rt_search_data['id'] if rt_search_data is not None else None
+            if cache is not None:
+                cache['search'].put(title_year, rt_id)
+        except QuotaExceeded:
+            raise
+        except Exception:
+            if raise_errors:
+                raise
+            rt_id = None
+        if rt_id is None and verbose:
+            print('RT: No film ID matched to %s (%s)' % (title, year))
+    
+    if rt_id is not None:
+        if cache is not None and rt_id in cache['film_info']:
+            rt_data = cache['film_info'][rt_id]
+        else:
+            try:
+                rt_data = film_info(rt_id, api_key, http_max_attempts=http_max_attempts,
+                                    limiter=limiter)
+                if 'error' in rt_data:
+                    raise Exception('Rotten Tomatoes API returned error: %s' % rt_data['error'])
+                if cache is not None:
+                    cache['film_info'].put(rt_id, rt_data)
+            except QuotaExceeded:
+                raise
+            except Exception:
+                if raise_errors:
+                    raise
+                rt_data = {}
+        # verbose mode gives a heads-up if the title wasn't a precise match        
+        if verbose and 'title' in rt_data and re.sub('\W', '', rt_data['title']).lower() != re.sub('\W', '', title).lower():
+            print('RT: Using %s for %s (%s)' % (rt_data['title'], title, year))
+    else:
+        rt_data = {}
+    
+    row = {}
+    try: row['mpaa_rating'] = rt_data['mpaa_rating']
+    except: row['mpaa_rating'] = None
+    try: row['runtime'] = int(rt_data['runtime'])
+    except: row['runtime'] = None
+    try: row['genres'] = ','.join(rt_data['genres'])
+    except: row['genres'] = None
+    try: row['rt_id'] = rt_data['id']
+    except: row['rt_id'] = None
+    try: row['imdb_id'] = rt_data['alternate_ids']['imdb']
+    except: row['imdb_id'] = None
+    
+    try:
+        directors = []
+        for director in rt_data['abridged_directors']:
+            if 'name' in director:
+                directors.append(director['name'])
+        row['directors'] = ','.join(directors)
+    except:
+        row['directors'] = None
+    try:
+        actors = []
+        for actor in rt_data['abridged_cast']:
+            if 'name' in actor:
+                actors.append(actor['name'])
+        row['actors'] = ','.join(actors)
+    except:
+        row['actors'] = None
+    
+    return row
+
+def film_info(id, api_key, http_max_attempts=3, limiter=None):
     
     rt_query = r'http://api.rottentomatoes.com/api/public/v1.0/movies/%s.json' % id
     rt_url = '%s?apikey=%s' % (rt_query, api_key)
-    return json.loads(http_query(rt_url, http_max_attempts=http_max_attempts).read())
+    return rt_api(rt_url, http_max_attempts=http_max_attempts, limiter=limiter)
 
-def search_by_title(title, api_key, http_max_attempts=3):
+def search_by_title(title, api_key, http_max_attempts=3, limiter=None):
     
     rt_query = r'http://api.rottentomatoes.com/api/public/v1.0/movies.json'
     rt_url = '%s?apikey=%s&q=%s' % (rt_query, api_key, urllib.quote(title.encode('utf-8')))
-    return json.loads(http_query(rt_url, http_max_attempts=http_max_attempts).read())
+    return rt_api(rt_url, http_max_attempts=http_max_attempts, limiter=limiter)
+
+def rt_api(rt_url, http_max_attempts=3, limiter=None):
+    '''
+    Returns the parsed JSON response from rt_url; an error response is 
+    returned too, but kept out of the HTTP cache. limiter, if given, is 
+    charged for every request actually sent, retries included. 
+    '''
+    result = json.loads(http_get(rt_url, http_max_attempts=http_max_attempts, limiter=limiter))
+    if 'error' in result:
+        forget_http_response(rt_url)
+    return result
 
-def film_search_best_hit(title, year, api_key, http_max_attempts=3, verbose=False):
+def film_search_best_hit(title, year, api_key, http_max_attempts=3, limiter=None, verbose=False):
     
     year = int(year)
     
-    search_data = search_by_title(title, api_key, http_max_attempts=http_max_attempts)
+    search_data = search_by_title(title, api_key, http_max_attempts=http_max_attempts,
+                                  limiter=limiter)
     if 'error' in search_data:
         raise Exception('Rotten Tomatoes API returned error: %s' % search_data['error'])
     
@@ -1,12 +1,324 @@
+import hashlib
+import httplib
+import os
+import os.path
+import Queue
+import random
+import simplejson as json
+import socket
+import StringIO
+import threading
+import time
 import urllib2
+import urlparse
 
 def http_query(url, http_max_attempts=3):
-    '''HTTP query, retries up to http_max_attempts until throwing an exception.'''
-    attempts = 0
-    while True:
-        try:
-            return urllib2.urlopen(url)
-        except urllib2.HTTPError as e:
-            attempts += 1
-            if attempts >= http_max_attempts:
-                raise e
+    '''
+    HTTP query, retries up to http_max_attempts until throwing an exception.
+    Returns a file-like object; goes through http_get(). 
+    '''
+    return StringIO.StringIO(http_get(url, http_max_attempts=http_max_attempts))
+
+class Journal(object):
+
+    '''
+    Append-only record of per-item results in filename, one JSON line per
+    item, so that a restarted run can skip the items it already finished.
+    Behaves like a read-only dict of the recorded results; put() records a
+    new one immediately.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.lock = threading.Lock()
+        complete = True
+        if os.path.isfile(filename):
+            with open(filename, 'r') as f:
+                for line in f:
+                    complete = line.endswith('\n')
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:   # cut off by an interrupted run
+                        continue
+                    self.entries[entry['key']] = entry['value']
+        self.file = open(filename, 'a')
+        if not complete:
+            self.file.write('\n')
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        return self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.file.write(json.dumps({ 'key': key, 'value': value }) + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class RateLimiter(object):
+
+    '''
+    Thread-safe limit on how often something happens: acquire() blocks so
+    that calls across all threads are spaced at least 1/rate seconds apart.
+    A rate of None means no limit.
+    '''
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+class QuotaExceeded(Exception):
+    pass
+
+class QuotaLimiter(object):
+
+    '''
+    Thread-safe token bucket for an API with a per-second and a per-day 
+    request quota. acquire() takes one token, blocking while the bucket 
+    (which holds up to per_second tokens and refills at per_second a 
+    second) is empty, so bursts of concurrent requests are allowed up to 
+    the per-second limit. Once per_day requests have been made in the 
+    current (UTC) day, acquire() raises QuotaExceeded. If state_file is 
+    given, the day's count is saved there so it carries across runs. None
+    means no limit. 
+    '''
+
+    def __init__(self, per_second=None, per_day=None, state_file=None):
+        self.per_second = per_second
+        self.per_day = per_day
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        self.tokens = float(per_second) if per_second else 0.0
+        self.last_time = time.time()
+        self.day = time.strftime('%Y-%m-%d', time.gmtime())
+        self.used = 0
+        if state_file is not None and os.path.isfile(state_file):
+            state = json.loads(open(state_file, 'r').read())
+            if state['day'] == self.day:
+                self.used = state['used']
+
+    def acquire(self):
+        with self.lock:
+            day = time.strftime('%Y-%m-%d', time.gmtime())
+            if day != self.day:
+                (self.day, self.used) = (day, 0)
+            if self.per_day is not None and self.used >= self.per_day:
+                raise QuotaExceeded('Error: daily quota of %d requests used up' % self.per_day)
+            self.used += 1
+            if self.state_file is not None:
+                with open(self.state_file + '.tmp', 'w') as f:
+                    f.write(json.dumps({ 'day': self.day, 'used': self.used }))
+                os.rename(self.state_file + '.tmp', self.state_file)
+            if not self.per_second:
+                return
+            now = time.time()
+            self.tokens = min(float(self.per_second),
+                              self.tokens + (now - self.last_time) * self.per_second)
+            self.last_time = now
+            # tokens may go negative: later callers then wait their turn
+            self.tokens -= 1
+            wait = -self.tokens / self.per_second if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+class HttpClient(object):
+
+    '''
+    Shared HTTP GET layer. Keeps one persistent connection per host in each
+    thread and reuses it across calls; waits timeout seconds for a response.
+    Failed requests (dropped connections, timeouts, 429 and 5xx responses)
+    are retried up to http_max_attempts times in all, sleeping a random
+    time of up to backoff * 2^n (capped at max_backoff) before the nth 
+    retry; other 4xx responses raise urllib2.HTTPError right away. 
+
+    If cache_dir is given, response bodies are saved there keyed by the
+    hash of the URL (except for calls to get() with cache=False), and a URL
+    found there is answered from disk without touching the network, so a 
+    scrape can be replayed offline. Cached responses never expire: delete
+    cache_dir to start afresh, or forget() a URL whose response turned out 
+    to be an error. counts() returns the number of requests made and bytes 
+    received so far. A limiter (a RateLimiter or QuotaLimiter) passed to 
+    get() is acquired before every request that goes out over the network,
+    retries and redirects included, and never for answers from the cache.
+    '''
+
+    def __init__(self, timeout=60, backoff=0.5, max_backoff=30.0, max_redirects=5,
+                 cache_dir=None):
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_redirects = max_redirects
+        self.cache_dir = cache_dir
+        self.local = threading.local()
+        self.count_lock = threading.Lock()
+        self.requests = 0
+        self.bytes_received = 0
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def cache_filename(self, url):
+        key = hashlib.md5(url).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def connection(self, scheme, netloc):
+        if not hasattr(self.local, 'pool'):
+            self.local.pool = {}
+        if (scheme, netloc) not in self.local.pool:
+            if scheme == 'https':
+                connection = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                connection = httplib.HTTPConnection(netloc, timeout=self.timeout)
+            self.local.pool[(scheme, netloc)] = connection
+        return self.local.pool[(scheme, netloc)]
+
+    def drop_connection(self, scheme, netloc):
+        self.local.pool.pop((scheme, netloc)).close()
+
+    def get(self, url, http_max_attempts=3, cache=True, limiter=None):
+        '''
+        Returns the body of the response to a GET of url, from (and saved 
+        to) the cache unless cache is False. 
+        '''
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        if self.cache_dir is None or not cache:
+            return self.fetch(url, http_max_attempts, limiter)
+        filename = self.cache_filename(url)
+        if os.path.isfile(filename):
+            with open(filename, 'rb') as f:
+                return f.read()
+
+        body = self.fetch(url, http_max_attempts, limiter)
+
+        if not os.path.isdir(os.path.dirname(filename)):
+            try:
+                os.makedirs(os.path.dirname(filename))
+            except OSError:   # made by another thread in the meantime
+                pass
+        tmp_filename = '%s.%d.tmp' % (filename, threading.current_thread().ident)
+        with open(tmp_filename, 'wb') as f:
+            f.write(body)
+        os.rename(tmp_filename, filename)
+        return body
+
+    def forget(self, url):
+        '''Removes the cached response for url, if any.'''
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        if self.cache_dir is not None and os.path.isfile(self.cache_filename(url)):
+            os.remove(self.cache_filename(url))
+
+    def fetch(self, url, http_max_attempts=3, limiter=None):
+        attempts = 0
+        redirects = 0
+        while True:
+            parts = urlparse.urlsplit(url)
+            path = (parts.path or '/') + ('?%s' % parts.query if parts.query else '')
+            connection = self.connection(parts.scheme, parts.netloc)
+            if limiter is not None:
+                limiter.acquire()
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                body = response.read()
+                with self.count_lock:
+                    self.requests += 1
+                    self.bytes_received += len(body)
+            except (httplib.HTTPException, socket.error):
+                self.drop_connection(parts.scheme, parts.netloc)
+                attempts += 1
+                if attempts >= http_max_attempts:
+                    raise
+                self.wait(attempts)
+                continue
+            if response.status in (301, 302, 303, 307, 308) and redirects < self.max_redirects:
+                url = urlparse.urljoin(url, response.getheader('location'))
+                redirects += 1
+                continue
+            if response.status >= 400:
+                attempts += 1
+                if (response.status != 429 and response.status < 500) or attempts >= http_max_attempts:
+                    raise urllib2.HTTPError(url, response.status, response.reason, response.msg, None)
+                self.wait(attempts)
+                continue
+            return body
+
+    def counts(self):
+        return (self.requests, self.bytes_received)
+
+    def wait(self, attempts):
+        time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempts - 1))))
+
+http_client = HttpClient()
+
+def configure_http_client(**kwargs):
+    '''
+    Replaces the HttpClient used by http_get() (and so by all the retrieval
+    modules) with one built from kwargs, e.g. cache_dir or timeout. 
+    '''
+    global http_client
+    http_client = HttpClient(**kwargs)
+    return http_client
+
+def http_get(url, http_max_attempts=3, cache=True, limiter=None):
+    '''HTTP GET through the shared HttpClient, returns the response body.'''
+    return http_client.get(url, http_max_attempts=http_max_attempts, cache=cache,
+                           limiter=limiter)
+
+def forget_http_response(url):
+    '''
+    Drops url from the shared HttpClient's cache; for responses that came 
+    back fine over HTTP but that the caller found to be an error. 
+    '''
+    http_client.forget(url)
+
+def http_get_many(urls, http_max_attempts=3, n_threads=8):
+    '''
+    http_get() of each of urls, n_threads at a time. Returns the bodies in
+    the same order as urls; if any request fails, raises its exception. 
+    '''
+    bodies = [None] * len(urls)
+    tasks = Queue.Queue()
+    for (k, url) in enumerate(urls):
+        tasks.put((k, url))
+    errors = []
+
+    def worker():
+        while not errors:
+            try:
+                (k, url) = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                bodies[k] = http_get(url, http_max_attempts=http_max_attempts)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(min(n_threads, len(urls)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return bodies
@@ -1,46 +1,199 @@
-from utilities import http_query
+from revisionstore import FilmRevisions, RevisionStore, has_revision_store, parse_timestamps, revision_key, store_subdir
+from utilities import RateLimiter, forget_http_response, http_get
 import datetime
 import hashlib
 import joblib
+import numpy as np
 import os.path
+import Queue
 import re
 import simplejson as json
+import utilities
+import threading
+import time
 import urllib
 import yaml
 
-def film_revision_scrape(films, output_dir, horizon_start=0, horizon_end=28, 
-                         http_max_attempts=3, verbose=False):
+wikipedia_api_url = r'http://en.wikipedia.org/w/api.php'
+
+def film_revision_scrape(films, output_dir, horizon_start=0, horizon_end=28,
+                         http_max_attempts=3, n_threads=1, requests_per_second=None,
+                         skip_existing=True, api_url=wikipedia_api_url, store=True,
+                         content_sample=None, metadata_rvlimit=5000, progress=None,
+                         verbose=False):
     
     '''
     Queries Wikipedia for the revision information stored in dataframe films
-    and saves it into directory output_dir as joblib-pickled files. Each film's
-    data is stored in a file whose name is the hash of the title and year. 
-    Use load_wikipedia_revisions() to load this data back in once this has
+    and saves it into directory output_dir. Use load_wikipedia_revisions() or
+    load_wikipedia_revision_view() to load this data back in once this has
     been run. 
+    
+    With store, revisions go into the revision store in output_dir (see 
+    revisionstore.RevisionStore), one API batch at a time as they arrive, 
+    so only one batch per thread is ever held in memory. The position in 
+    each film's revision history is saved along with every batch, and a 
+    film whose download was interrupted resumes from there on the next run; 
+    a film is only marked complete (and visible to the loaders) once all of
+    its revisions are in. Without store, each film's data is stored as a 
+    joblib-pickled file whose name is the hash of the title, written once 
+    the film's revisions are complete. 
+    
+    Films are fetched by n_threads threads at once (so up to n_threads 
+    requests are in flight), with at most requests_per_second requests 
+    across all of them. With skip_existing, films already complete (in the 
+    store or as a file) are not fetched again, so an interrupted scrape can
+    just be rerun. progress, if given, is called with (films done, total 
+    films) as films finish. 
+    
+    content_sample (which needs store) switches to a two-tier scrape: 
+    revision metadata is fetched without content, metadata_rvlimit 
+    revisions per request, and content only for a sample of the revisions,
+    either 'daily' (the last revision of each day) or an integer k (every 
+    kth revision). See film_revision_batches(). Text features are then 
+    averaged over the sampled revisions. 
     '''
     
+    for i in films.index:
+        if films.ix[i]['wiki_title'] is None:
+            raise Exception('Error: no wiki_title found for film %s, index %i' % (films.ix[i]['title'], i))
+    if content_sample is not None and not store:
+        raise Exception('Error: content_sample requires store')
+    start_time = time.time()
+    start_counts = utilities.http_client.counts()
+    
+    if store:
+        revision_store = RevisionStore(os.path.join(output_dir, store_subdir), mode='a')
+    else:
+        revision_store = None
+    store_lock = threading.Lock()
+    
+    tasks = Queue.Queue()
+    done = [0]
+    progress_lock = threading.Lock()
+    def film_done():
+        with progress_lock:
+            done[0] += 1
+            if progress is not None:
+                progress(done[0], len(films.index))
+    
     for i in films.index:
         film = films.ix[i]
-        if film['wiki_title'] is not None:
-            revisions = film_revisions(film, horizon_start, horizon_end, 
-                                       http_max_attempts=http_max_attempts,
-                                       verbose=verbose)
+        key = revision_key(film['wiki_title'])
+        filename = os.path.join(output_dir, '%s.revisions' % key)
+        if skip_existing and (os.path.isfile(filename) or 
+                              (revision_store is not None and revision_store.is_complete(key))):
             if verbose:
-                print '(%d) %s / %d revisions' % (i, film['wiki_title'], len(revisions))
-            filename = '%s.revisions' % hashlib.md5(film['wiki_title'].encode('utf-8')).hexdigest()
-            filename = os.path.join(output_dir, filename)
-            joblib.dump(revisions, filename)
-        else:
-            raise Exception('Error: no wiki_title found for film %s, index %i' % (film['title'], i))
+                print('(%d) %s / already scraped' % (i, film['wiki_title']))
+            film_done()
+            continue
+        if revision_store is not None and (not skip_existing or revision_store.cursor(key) is None):
+            revision_store.remove(key)   # start over rather than resume
+        tasks.put((i, film, key, filename))
+    
+    rate_limiter = RateLimiter(requests_per_second)
+    errors = []
+    
+    def scrape_to_store(i, film, key):
+        count = 0
+        with store_lock:
+            cursor = revision_store.cursor(key)
+            sample_state = revision_store.sample_state(key)
+        if verbose and cursor is not None:
+            print('(%d) %s / resuming' % (i, film['wiki_title']))
+        batches = film_revision_batches(film, horizon_start, horizon_end,
+                                        http_max_attempts=http_max_attempts,
+                                        rate_limiter=rate_limiter, api_url=api_url, 
+                                        cursor=cursor, content_sample=content_sample,
+                                        metadata_rvlimit=metadata_rvlimit, 
+                                        sample_state=sample_state)
+        for (revisions, cursor, sample_state) in batches:
+            with store_lock:
+                revision_store.append(key, revisions, title=film['wiki_title'])
+                revision_store.set_content_sample(key, content_sample)
+                revision_store.set_cursor(key, cursor, sample_state)
+                if cursor is None:
+                    revision_store.set_complete(key)
+                revision_store.flush()
+            count += len(revisions)
+        return count
+    
+    def worker():
+        while not errors:
+            try:
+                (i, film, key, filename) = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                if revision_store is not None:
+                    count = scrape_to_store(i, film, key)
+                else:
+                    revisions = film_revisions(film, horizon_start, horizon_end, 
+                                               http_max_attempts=http_max_attempts,
+                                               rate_limiter=rate_limiter, api_url=api_url,
+                                               verbose=verbose)
+                    count = len(revisions)
+                    joblib.dump(revisions, filename + '.tmp')
+                    os.rename(filename + '.tmp', filename)
+                if verbose:
+                    print('(%d) %s / %d revisions' % (i, film['wiki_title'], count))
+                film_done()
+            except Exception as e:
+                errors.append(e)
+    
+    threads = [threading.Thread(target=worker) for k in range(max(1, n_threads))]
+    try:
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        if revision_store is not None:
+            with store_lock:
+                revision_store.close()
+    if errors:
+        raise errors[0]
+    if verbose:
+        (requests, received) = [b - a for (a, b) in zip(start_counts, utilities.http_client.counts())]
+        print('Downloaded %.1f MB in %d requests, %.0f seconds' % 
+              (received / 2.0**20, requests, time.time() - start_time))
 
-def film_revisions(film, horizon_start=0, horizon_end=28, http_max_attempts=3, verbose=False):
+def film_revisions(film, horizon_start=0, horizon_end=28, http_max_attempts=3, 
+                   rate_limiter=None, api_url=wikipedia_api_url, verbose=False):
     
     '''
     Retrieves the revisions for film between horizon_start and horizon_end days
-    prior to its opening date. 
+    prior to its opening date. If given, rate_limiter is acquired before 
+    every request. 
     '''
     
     all_revisions = []
+    batches = film_revision_batches(film, horizon_start, horizon_end,
+                                    http_max_attempts=http_max_attempts,
+                                    rate_limiter=rate_limiter, api_url=api_url)
+    for (revisions, cursor, sample_state) in batches:
+        all_revisions.extend(revisions)
+    return all_revisions
+
+def film_revision_batches(film, horizon_start=0, horizon_end=28, http_max_attempts=3,
+                          rate_limiter=None, api_url=wikipedia_api_url, cursor=None,
+                          content_sample=None, metadata_rvlimit=5000, sample_state=None):
+    
+    '''
+    Generator version of film_revisions(): yields the revisions one API batch
+    at a time, as (revisions, cursor, sample_state) triples, where cursor and
+    sample_state are what to pass back in to resume after that batch (cursor
+    None after the last one). 
+    
+    If content_sample is given, batches of up to metadata_rvlimit revisions 
+    are fetched without content, and then the content of the revisions 
+    picked by sample_revisions() is fetched by revision id and filled in. 
+    (The API caps metadata_rvlimit at 500 for clients without the bot 
+    right, against 50 with content.) sample_state carries the sampling 
+    over from the batches before the cursor, so that a resumed download 
+    samples the same revisions as an uninterrupted one. 
+    '''
+    
     api_params = { 'format': 'json', 
                    'action': 'query',
                    'redirects': None,
@@ -52,29 +205,143 @@ def film_revisions(film, horizon_start=0, horizon_end=28, http_max_attempts=3, v
                    'rvstart': mediawiki_timestamp(film['opening_date'] - datetime.timedelta(days=horizon_start)),
                    'rvend': mediawiki_timestamp(film['opening_date'] - datetime.timedelta(days=horizon_end)),
                   }
+    if cursor is not None:   # first call uses rvstart, the rest use rvstartid
+        del api_params['rvstart']
+        api_params['rvstartid'] = cursor
+    if content_sample is not None:
+        api_params['rvprop'] = [x for x in api_params['rvprop'] if x != 'content']
+        api_params['rvlimit'] = metadata_rvlimit
     
     while True:
-        query_result = wikipedia_api(api_params, http_max_attempts=http_max_attempts)
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        # revision content is far too bulky to keep a second copy of
+        query_result = wikipedia_api(api_params, http_max_attempts=http_max_attempts,
+                                     api_url=api_url, cache=content_sample is not None)
         pages = query_result['query']['pages']
         if len(pages) < 1 or pages.keys()[0] == -1:
-            raise Exception('No Wikipedia page found for %s' % title)
+            raise Exception('No Wikipedia page found for %s' % film['wiki_title'])
         if 'revisions' not in pages.items()[0][1]:  # no revisions, or article did not exist
-            break
+            yield ([], None, sample_state)
+            return
         revisions = pages.items()[0][1]['revisions']
-        all_revisions.extend(revisions)
+        if content_sample is not None:
+            (sample, sample_state) = sample_revisions(revisions, content_sample, sample_state)
+            fetch_revision_contents([revisions[j] for j in sample], http_max_attempts=http_max_attempts,
+                                    rate_limiter=rate_limiter, api_url=api_url)
         if 'query-continue' in query_result:
-            if 'rvstart' in api_params:   # first call uses rvstart, the rest use rvstartid
-                del api_params['rvstart']
-            api_params['rvstartid'] = query_result['query-continue']['revisions']['rvcontinue']
+            cursor = query_result['query-continue']['revisions']['rvcontinue']
+            yield (revisions, cursor, sample_state)
+            api_params.pop('rvstart', None)
+            api_params['rvstartid'] = cursor
         else:
-            break
-        
-    return all_revisions
+            yield (revisions, None, sample_state)
+            return
+
+def sample_revisions(revisions, content_sample, state=None):
+    
+    '''
+    Picks which of a batch of revisions (newest first, as the API returns 
+    them) to fetch content for: with content_sample 'daily', the last 
+    revision of each (UTC) day; with an integer k, every kth revision. 
+    state carries over between consecutive batches (start with None). 
+    Returns (positions in revisions, new state). 
+    '''
+    
+    sample = []
+    if content_sample == 'daily':
+        for (j, rev) in enumerate(revisions):
+            day = rev['timestamp'][:10]
+            if day != state:
+                sample.append(j)
+                state = day
+    else:
+        seen = state or 0
+        for j in range(len(revisions)):
+            if (seen + j) % content_sample == 0:
+                sample.append(j)
+        state = seen + len(revisions)
+    return (sample, state)
+
+def fetch_revision_contents(revisions, batch_size=50, http_max_attempts=3, 
+                            rate_limiter=None, api_url=wikipedia_api_url):
+    '''
+    Fills in the content ('*') of the given revision dicts in place, querying
+    by revision id, batch_size revisions per request. 
+    '''
+    by_revid = dict((rev['revid'], rev) for rev in revisions)
+    revids = sorted(by_revid)
+    for start in range(0, len(revids), batch_size):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        query_params = { 'format': 'json',
+                         'action': 'query',
+                         'prop': 'revisions',
+                         'rvprop': ['ids', 'content'],
+                         'revids': ['%d' % x for x in revids[start:start + batch_size]] }
+        query_result = wikipedia_api(query_params, http_max_attempts=http_max_attempts,
+                                     api_url=api_url, cache=False)
+        for page in query_result['query']['pages'].values():
+            for rev in page.get('revisions', []):
+                if '*' in rev and rev['revid'] in by_revid:
+                    by_revid[rev['revid']]['*'] = rev['*']
+
+def film_revision_updates(film, since_revid=None, horizon_start=0, horizon_end=28,
+                          http_max_attempts=3, rate_limiter=None, api_url=wikipedia_api_url):
+    
+    '''
+    Yields the revisions for film in the same horizon as film_revisions() that 
+    are newer than revision since_revid (all of them if None), for keeping up
+    with an upcoming film's article as it is edited. Batches come oldest 
+    first, but the revisions within each are newest first like everywhere 
+    else. 
+    '''
+    
+    api_params = { 'format': 'json', 
+                   'action': 'query',
+                   'redirects': None,
+                   'prop': 'revisions',
+                   'rvlimit': 50,
+                   'rvdir': 'newer',
+                   'rvprop': ['ids', 'user', 'userid', 'timestamp', 'flags', 'comment', 'size', 'content'],
+                   'titles': urllib.quote(film['wiki_title'].encode('utf-8')),
+                   'rvstart': mediawiki_timestamp(film['opening_date'] - datetime.timedelta(days=horizon_end)),
+                   'rvend': mediawiki_timestamp(film['opening_date'] - datetime.timedelta(days=horizon_start)),
+                  }
+    if since_revid is not None:   # rvstartid is inclusive, so since_revid comes back too
+        del api_params['rvstart']
+        api_params['rvstartid'] = since_revid
+    
+    while True:
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        # never cached: the same query returns more as the article is edited
+        query_result = wikipedia_api(api_params, http_max_attempts=http_max_attempts,
+                                     api_url=api_url, cache=False)
+        pages = query_result['query']['pages']
+        if len(pages) < 1 or pages.keys()[0] == -1:
+            raise Exception('No Wikipedia page found for %s' % film['wiki_title'])
+        revisions = pages.items()[0][1].get('revisions', [])
+        revisions = [rev for rev in revisions if rev.get('revid') != since_revid]
+        if len(revisions) > 0:
+            yield revisions[::-1]
+        if 'query-continue' not in query_result:
+            return
+        api_params.pop('rvstart', None)
+        api_params['rvstartid'] = query_result['query-continue']['revisions']['rvcontinue']
 
-def attach_wikipedia_titles(films, config_file=None, http_max_attempts=3, verbose=False):
+def attach_wikipedia_titles(films, config_file=None, http_max_attempts=3, 
+                            batch_size=50, api_url=wikipedia_api_url,
+                            journal=None, progress=None, verbose=False):
     
     '''
     Attaches Wikipedia article titles to the dataframe films and returns it. 
+    Candidate titles are first checked for all films at once (see 
+    batch_wikipedia_titles()), and only the films left unresolved are 
+    searched for one at a time. If journal (a utilities.Journal) is given, 
+    each title is recorded in it as soon as it is found, and films already 
+    recorded there are not queried again. progress, if given, is called 
+    with (films done, total films). 
     '''
     
     if config_file is not None:
@@ -82,15 +349,32 @@ def attach_wikipedia_titles(films, config_file=None, http_max_attempts=3, verbos
     else:
         config = {}
     
-    wiki_titles = []
+    pending = []
     for i in films.index:
+        title_year = '%s (%d)' % (films.ix[i]['title'], films.ix[i]['year'])
+        if not ((journal is not None and title_year in journal) or
+                ('title_override' in config and title_year in config['title_override'])):
+            pending.append(i)
+    batch_titles = batch_wikipedia_titles(films.ix[pending], batch_size=batch_size,
+                                          http_max_attempts=http_max_attempts, api_url=api_url)
+    
+    wiki_titles = []
+    for (k, i) in enumerate(films.index):
         film = films.ix[i]
         (title, year) = (film['title'], film['year'])
         title_year = '%s (%d)' % (title, year)
+        if journal is not None and title_year in journal:
+            wiki_titles.append(journal[title_year])
+            if progress is not None:
+                progress(k + 1, len(films.index))
+            continue
         if 'title_override' in config and title_year in config['title_override']:
             wiki_title = config['title_override'][title_year]
+        elif i in batch_titles:
+            wiki_title = batch_titles[i]
         else:
-            wiki_title = retrieve_wikipedia_title(films.ix[i], http_max_attempts=http_max_attempts)
+            wiki_title = retrieve_wikipedia_title(films.ix[i], http_max_attempts=http_max_attempts,
+                                                  api_url=api_url)
         if verbose: 
             if wiki_title is not None:
                 clean_wiki_title = re.sub(' \((\d{4} ){0,1}film\)$', '', wiki_title)
@@ -99,10 +383,76 @@ def attach_wikipedia_titles(films, config_file=None, http_max_attempts=3, verbos
             else:
                 print('W: No Wikipedia article found for %s' % title)
         wiki_titles.append(wiki_title)
+        if journal is not None:
+            journal.put(title_year, wiki_title)
+        if progress is not None:
+            progress(k + 1, len(films.index))
     films['wiki_title'] = wiki_titles
     return films
 
-def retrieve_wikipedia_title(film, search_limit=15, http_max_attempts=3):
+def batch_wikipedia_titles(films, batch_size=50, http_max_attempts=3, api_url=wikipedia_api_url):
+    
+    '''
+    Resolves Wikipedia article titles for many films at once by checking 
+    the candidates "Title (year film)", "Title (film)" and "Title" for 
+    existence, batch_size titles per query, with the same order of 
+    precedence retrieve_wikipedia_title() applies to search hits. Each film
+    gets the first film-suffixed candidate that exists, or the bare title 
+    only if neither film-suffixed one exists. A candidate that is a redirect
+    counts as existing if the article it points to does, and is returned as
+    is, as the search would. Films whose chosen candidate is (or redirects 
+    to) a disambiguation page are not resolved. Returns a dict from index label of films to 
+    title, for the films resolved this way; the rest are left for 
+    retrieve_wikipedia_title(). 
+    '''
+    
+    candidates = {}
+    all_candidates = []
+    for i in films.index:
+        film = films.ix[i]
+        candidates[i] = [u'%s (%d film)' % (film['title'], film['year']),
+                         u'%s (film)' % film['title'],
+                         u'%s' % film['title']]
+        all_candidates.extend(candidates[i])
+    all_candidates = sorted(set(all_candidates))
+    
+    found = {}  # candidate -> (title, is disambiguation page)
+    for start in range(0, len(all_candidates), batch_size):
+        batch = all_candidates[start:start + batch_size]
+        query_params = { 'format': 'json',
+                         'action': 'query',
+                         'redirects': None,
+                         'prop': 'pageprops',
+                         'ppprop': 'disambiguation',
+                         'titles': [urllib.quote(x.encode('utf-8')) for x in batch] }
+        query = memoized_wikipedia_api(query_params, http_max_attempts=http_max_attempts,
+                                       api_url=api_url).get('query', {})
+        normalized = dict((x['from'], x['to']) for x in query.get('normalized', []))
+        redirects = dict((x['from'], x['to']) for x in query.get('redirects', []))
+        pages = dict((page['title'], page) for page in query.get('pages', {}).values())
+        for candidate in batch:
+            title = normalized.get(candidate, candidate)
+            target = title
+            for hop in range(len(redirects)):
+                if target not in redirects:
+                    break
+                target = redirects[target]
+            page = pages.get(target)
+            if page is not None and 'missing' not in page and 'invalid' not in page:
+                found[candidate] = (title, 'disambiguation' in page.get('pageprops', {}))
+    
+    titles = {}
+    for i in films.index:
+        film_candidates = [x for x in candidates[i][:2] if x in found]
+        if len(film_candidates) == 0 and candidates[i][2] in found:
+            film_candidates = [candidates[i][2]]
+        if len(film_candidates) > 0:
+            (title, disambiguation) = found[film_candidates[0]]
+            if not disambiguation:
+                titles[i] = title
+    return titles
+
+def retrieve_wikipedia_title(film, search_limit=15, http_max_attempts=3, api_url=wikipedia_api_url):
     '''
     Given film data (a dictionary with 'title' and 'year' or other data 
     structure that supports this indexing), attempts to retrieve the title of
@@ -119,7 +469,8 @@ def retrieve_wikipedia_title(film, search_limit=15, http_max_attempts=3):
                      'action': 'opensearch',
                      'search': urllib.quote(film['title'].encode('utf-8')),
                      'limit': search_limit }
-    query_result = wikipedia_api(query_params, http_max_attempts=http_max_attempts)
+    query_result = memoized_wikipedia_api(query_params, http_max_attempts=http_max_attempts,
+                                          api_url=api_url)
     hits = query_result[1]
     
     # easy cases first
@@ -152,13 +503,15 @@ def retrieve_wikipedia_title(film, search_limit=15, http_max_attempts=3):
                 
                 if len(hits) == search_limit:
                     query_params['search'] = (urllib.quote(film['title'].encode('utf-8') + (' (%d film)' % film['year'])))
-                    query_result2 = wikipedia_api(query_params, http_max_attempts=http_max_attempts)
+                    query_result2 = memoized_wikipedia_api(query_params, http_max_attempts=http_max_attempts,
+                                                           api_url=api_url)
                     hits2 = query_result2[1]
                     if len(hits2) > 0:
                         page = hits2[0]
                     else:
                         query_params['search'] = (urllib.quote(film['title'].encode('utf-8') + ' (film)'))
-                        query_result3 = wikipedia_api(query_params, http_max_attempts=http_max_attempts)
+                        query_result3 = memoized_wikipedia_api(query_params, http_max_attempts=http_max_attempts,
+                                                               api_url=api_url)
                         hits3 = query_result3[1]
                         if len(hits3) > 0:
                             page = hits3[0]
@@ -178,9 +531,13 @@ def find_re_matches(regexp, hits):
             matches.append(hit)
     return matches
 
-def wikipedia_api(arg_dict, http_max_attempts=3):
-    '''Makes a call to the Wikipedia API'''
-    api_url = r'http://en.wikipedia.org/w/api.php?'
+def wikipedia_api(arg_dict, http_max_attempts=3, api_url=wikipedia_api_url, cache=True):
+    '''
+    Makes a call to the Wikipedia API (or another MediaWiki API at api_url).
+    The response goes through the HTTP cache if cache is True and it is not
+    an error. 
+    '''
+    api_url += '?'
     url_args = []
     for key in arg_dict:
         if arg_dict[key] is None:
@@ -190,7 +547,21 @@ def wikipedia_api(arg_dict, http_max_attempts=3):
         else:
             url_args.append('%s=%s' % (key, arg_dict[key]))
     api_url += '&'.join(url_args)
-    return json.loads(http_query(api_url, http_max_attempts=http_max_attempts).read())
+    result = json.loads(http_get(api_url, http_max_attempts=http_max_attempts, cache=cache))
+    if cache and 'error' in result:
+        forget_http_response(api_url)
+    return result
+
+_api_results = {}
+
+def memoized_wikipedia_api(arg_dict, http_max_attempts=3, api_url=wikipedia_api_url):
+    '''wikipedia_api(), remembering every result for the life of the process'''
+    key = (api_url, tuple(sorted((k, tuple(v) if isinstance(v, list) else v) 
+                                 for (k, v) in arg_dict.items())))
+    if key not in _api_results:
+        _api_results[key] = wikipedia_api(arg_dict, http_max_attempts=http_max_attempts,
+                                          api_url=api_url)
+    return _api_results[key]
 
 def mediawiki_timestamp(dt):
     '''Converts a timestamp to the format needed for the MediaWiki API.'''
@@ -199,14 +570,91 @@ def mediawiki_timestamp(dt):
     else:
         return '%04d%02d%02d%02d%02d%02d' % (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
 
+_open_stores = {}  # path -> (index.json stat, store)
+
+def open_revision_store(output_dir):
+    '''
+    Returns the (cached) revision store in output_dir, opened for reading. 
+    It is reopened whenever the store's index.json has changed since (every
+    flush rewrites it), so films added by a scrape or conversion in the 
+    meantime are seen. 
+    '''
+    path = os.path.join(output_dir, store_subdir)
+    index_file = os.path.join(path, 'index.json')
+    if os.path.isfile(index_file):
+        stat = os.stat(index_file)
+        stamp = (stat.st_mtime, stat.st_size, stat.st_ino)
+    else:
+        stamp = None
+    if path not in _open_stores or _open_stores[path][0] != stamp:
+        _open_stores[path] = (stamp, RevisionStore(path, mode='r'))
+    return _open_stores[path][1]
+
+def load_wikipedia_revision_view(film, output_dir):
+    '''
+    Loads the revisions for film from output_dir as a FilmRevisions view, 
+    from the revision store if output_dir has one (see 
+    revisionstore.convert_revision_pickles()), otherwise from the film's
+    pickle file. 
+    '''
+    key = revision_key(film['wiki_title'])
+    if has_revision_store(output_dir):
+        store = open_revision_store(output_dir)
+        if store.is_complete(key):
+            return store.film(key)
+    filename = os.path.join(output_dir, '%s.revisions' % key)
+    if not os.path.isfile(filename):
+        raise Exception('Error: expected file %s not found for %s' % (filename, film['wiki_title']))
+    return FilmRevisions.from_dicts(joblib.load(filename))
+
+_file_fingerprints = {}
+
+def revision_fingerprint(film, output_dir):
+    '''
+    Returns a hash identifying the revision data stored for film in 
+    output_dir: the md5 of its pickle file (remembered per file size and 
+    modification time), or of its metadata columns in the revision store. 
+    '''
+    key = revision_key(film['wiki_title'])
+    if has_revision_store(output_dir):
+        store = open_revision_store(output_dir)
+        if store.is_complete(key):
+            view = store.film(key)
+            digest = hashlib.md5()
+            for array in (view.timestamp, view.size, view.user, view.revid, view.minor,
+                          view.content_offset, view.content_length):
+                digest.update(np.ascontiguousarray(array).tostring())
+            return digest.hexdigest()
+    filename = os.path.join(output_dir, '%s.revisions' % key)
+    if not os.path.isfile(filename):
+        raise Exception('Error: expected file %s not found for %s' % (filename, film['wiki_title']))
+    stat = os.stat(filename)
+    if (filename, stat.st_size, stat.st_mtime) not in _file_fingerprints:
+        digest = hashlib.md5()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        _file_fingerprints[(filename, stat.st_size, stat.st_mtime)] = digest.hexdigest()
+    return _file_fingerprints[(filename, stat.st_size, stat.st_mtime)]
+
 def load_wikipedia_revisions(film, output_dir):
-    '''Loads the revisions for film from the corresponding file in output_dir.'''
-    filename = '%s.revisions' % hashlib.md5(film['wiki_title'].encode('utf-8')).hexdigest()
+    '''
+    Loads the revisions for film from the corresponding file in output_dir,
+    as a list of the API's revision dicts with timestamps converted to 
+    datetimes. If the film is in output_dir's revision store, the dicts 
+    come from the store instead and only have the fields it keeps (see 
+    FilmRevisions.__iter__()): no 'comment', 'userid', 'parentid' or 'anon'. 
+    '''
+    if has_revision_store(output_dir) and open_revision_store(output_dir).is_complete(revision_key(film['wiki_title'])):
+        return list(load_wikipedia_revision_view(film, output_dir))
+    filename = '%s.revisions' % revision_key(film['wiki_title'])
     filename = os.path.join(output_dir, filename)
     if not os.path.isfile(filename):
         raise Exception('Error: expected file %s not found for %s' % (filename, film['wiki_title']))
     revisions = joblib.load(filename)
-    for rev in revisions:
-        if 'timestamp' in rev:
-            rev['timestamp'] = datetime.datetime.strptime(rev['timestamp'], '%Y-%m-%dT%H:%M:%SZ')
+    timestamped = [rev for rev in revisions if 'timestamp' in rev]
+    seconds = parse_timestamps([rev['timestamp'] for rev in timestamped])
+    epoch = datetime.datetime(1970, 1, 1)
+    for (rev, t) in zip(timestamped, seconds):
+        rev['timestamp'] = epoch + datetime.timedelta(seconds=int(t))
     return revisions
\ No newline at end of file
@@ -4,4 +4,8 @@ if __name__ == '__main__':
     retrieval.retrieve_all_data(range(2002, 2013),
                                 'films.csv',
                                 wikipedia_scrape_dir='revisions',
+                                rottentomatoes_threads=4,
+                                rottentomatoes_requests_per_second=5,
+                                rottentomatoes_requests_per_day=10000,
+                                rottentomatoes_cache_dir='rt_cache',
                                 verbose=True)
\ No newline at end of file
@@ -0,0 +1,36 @@
+import features
+import retrieval
+import sys
+
+# Predicts with the models saved by fit.py instead of refitting them. Scores 
+# the films in films.csv released in the year given on the command line 
+# (2012, the test year, by default). 
+
+if __name__ == '__main__':
+    
+    year = int(sys.argv[1]) if len(sys.argv) > 1 else 2012
+    films = retrieval.read_film_csv('films.csv')
+    score_index = films.index[films['year'] == year]
+    
+    cache = features.FeatureCache('feature_cache', max_bytes=512 * 2**20)
+    model = features.load_model('model.saved')
+    model_nowiki = features.load_model('model_nowiki.saved')
+    
+    # similarity scores for the films being scored, read once from the 
+    # scores fit.py stored and shared by both models
+    scores = {}
+    for saved in (model, model_nowiki):
+        if saved['metric'] not in scores:
+            scores[saved['metric']] = features.subsequence_score_columns(
+                films, features.saved_metric(saved), score_index, filename='subsequence.scores')
+    
+    result = features.score_films(model, films, score_index, 'revisions',
+                                  subsequence=scores[model['metric']], cache=cache)
+    result_nowiki = features.score_films(model_nowiki, films, score_index, 'revisions',
+                                         subsequence=scores[model_nowiki['metric']], cache=cache)
+    
+    print('With Wikipedia:')
+    print(result)
+    
+    print('Without Wikipedia:')
+    print(result_nowiki)